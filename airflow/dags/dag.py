@@ -34,46 +34,15 @@ cols = BashOperator(
     dag=dag
 )
 
-incoming_messages = BashOperator(
-    task_id='incoming_messages',
-    bash_command='python /src/incoming_messages.py',
+# One process runs every endpoint concurrently, sharing the HTTP pool, DB engine & rate limits.
+# The run summary (rows, per-stage times, request stats) is the last line, so it lands in XCom
+extract = BashOperator(
+    task_id='extract',
+    bash_command='RUN_SUMMARY=/tmp/mobile_commons_summary.json '
+    'python /src/mobile_commons_runner.py incoming_messages outgoing_messages profiles broadcasts groups tags urls_clicks '
+    '&& cat /tmp/mobile_commons_summary.json',
+    xcom_push=True,
     dag=dag
 )
 
-outgoing_messages = BashOperator(
-    task_id='outgoing_messages',
-    bash_command='python /src/outgoing_messages.py',
-    dag=dag
-)
-
-profiles = BashOperator(
-    task_id='profiles',
-    bash_command='python /src/profiles.py',
-    dag=dag
-)
-
-broadcasts = BashOperator(
-    task_id='broadcasts',
-    bash_command='python /src/broadcasts.py',
-    dag=dag
-)
-
-groups = BashOperator(
-    task_id='groups',
-    bash_command='python /src/groups.py',
-    dag=dag
-)
-
-tags = BashOperator(
-    task_id='tags',
-    bash_command='python /src/tags.py',
-    dag=dag
-)
-
-urls_clicks = BashOperator(
-    task_id='urls_clicks',
-    bash_command='python /src/urls_clicks.py',
-    dag=dag
-)
-
-cols >> incoming_messages >> outgoing_messages >> profiles >> broadcasts >> groups >> tags >> urls_clicks
+cols >> extract
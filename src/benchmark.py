@@ -0,0 +1,361 @@
+"""
+Benchmarks for the extraction hot paths, run with e.g. `python benchmark.py parse` or
+`python benchmark.py timestamps`. `python benchmark.py e2e` runs the real jobs against
+mobile_commons_mock and the warehouse configured by the DB_* variables
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import urllib.request
+
+import pandas as pd
+import xmltodict
+
+import mobile_commons_data as mcd
+import mobile_commons_parser as mcp
+import mobile_commons_timestamps as mct
+
+COLUMNS = mcd.columns()
+
+
+def message_page(rows, page=1, page_count=100):
+    """Builds a messages <response> page shaped like the real API output"""
+
+    records = []
+    for i in range(rows):
+        records.append(
+            '<message id="{id}" type="reply" approved="true">'
+            "<phone_number>+1555{phone:07d}</phone_number>"
+            "<profile>{profile}</profile>"
+            '<campaign id="{campaign}" active="true">Campaign {campaign}</campaign>'
+            "<carrier_name>Verizon Wireless</carrier_name>"
+            "<body>Reply {id} with a body of some realistic length for an SMS</body>"
+            "<received_at>2020-07-20 15:{minute:02d}:{second:02d} UTC</received_at>"
+            "<keyword>JOIN</keyword><mms>false</mms><multipart>false</multipart>"
+            "<message_template_id>{template}</message_template_id>"
+            "<next_id>{next}</next_id><previous_id>{previous}</previous_id>"
+            "</message>".format(
+                id=page * rows + i,
+                phone=random.randint(0, 9999999),
+                profile=random.randint(1, 10 ** 8),
+                campaign=random.randint(1, 500),
+                minute=i % 60,
+                second=(i * 7) % 60,
+                template=random.randint(1, 1000),
+                next=page * rows + i + 1,
+                previous=page * rows + i - 1,
+            )
+        )
+
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<response success="true"><messages page="{}" page_count="{}">{}</messages></response>'
+    ).format(page, page_count, "".join(records))
+
+
+def parse_legacy(r, columns):
+    """The xmltodict + json round-trip + json_normalize path ping_endpoint used to take"""
+
+    if json.loads(json.dumps(xmltodict.parse(r))).get("response") is not None:
+        json_xml = json.loads(json.dumps(xmltodict.parse(r)))
+        df = pd.json_normalize(json_xml["response"]["messages"]["message"], max_level=0)
+        df.columns = [
+            c.replace(".", "_").replace("@", "").replace("@_", "").replace("_@", "")
+            for c in df.columns
+        ]
+        return df.loc[:, df.columns.isin(list(columns.keys()))]
+
+
+def parse_iterparse(r, parser):
+    """The record_parser path ping_endpoint takes now"""
+
+    cols, rows, meta = parser.parse(r)
+    return pd.DataFrame(cols)
+
+
+def bench_parse(args):
+
+    columns = COLUMNS.columns["messages"]
+    parser = mcp.record_parser("message", "messages", columns.keys())
+
+    for rows in args.rows:
+        page = message_page(rows)
+        legacy = min(timeit.repeat(lambda: parse_legacy(page, columns), number=args.number, repeat=3)) / args.number
+        current = min(timeit.repeat(lambda: parse_iterparse(page, parser), number=args.number, repeat=3)) / args.number
+
+        print(
+            "{} rows/page: legacy {:.2f} ms, iterparse {:.2f} ms, speedup {:.1f}x".format(
+                rows, legacy * 1000, current * 1000, legacy / current
+            )
+        )
+
+
+def timestamp_column(rows, unique):
+    """received_at-like column of `rows` values drawn from `unique` distinct timestamps"""
+
+    start = pd.Timestamp("2020-07-20", tz="UTC")
+    seconds = pd.Series([random.randrange(unique) for _ in range(rows)])
+    return (start + pd.to_timedelta(seconds, unit="s")).dt.strftime("%Y-%m-%d %H:%M:%S UTC")
+
+
+def bench_timestamps(args):
+
+    column = timestamp_column(args.rows, args.unique)
+    # The old paths fall back to dateutil on every value, so they're timed on a sample
+    sample = column.head(args.legacy_rows)
+
+    paths = [
+        ("astype (old load)", sample, lambda c: c.astype("datetime64[ns, UTC]")),
+        ("to_datetime inference", sample, lambda c: pd.to_datetime(c, utc=True, errors="coerce")),
+        ("parse_timestamps", column, mct.parse_timestamps),
+    ]
+
+    assert (mct.parse_timestamps(sample) == sample.astype("datetime64[ns, UTC]")).all()
+
+    for name, values, path in paths:
+        seconds = min(timeit.repeat(lambda: path(values), number=1, repeat=args.repeat))
+        print(
+            "{}: {} rows ({} distinct) in {:.2f} s, {:,.0f} rows/s".format(
+                name, len(values), values.nunique(), seconds, len(values) / seconds
+            )
+        )
+
+    try:
+        import dateparser
+    except ImportError:
+        return
+
+    # What get_latest_record used to run on each value
+    values = sample.head(1000)
+    seconds = min(timeit.repeat(lambda: [dateparser.parse(v) for v in values], number=1, repeat=args.repeat))
+    print("dateparser: {} rows in {:.2f} s, {:,.0f} rows/s".format(len(values), seconds, len(values) / seconds))
+
+
+def free_port():
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def mock_stats(url):
+
+    with urllib.request.urlopen(url + "stats") as response:
+        return json.load(response)
+
+
+def start_mock(args, port):
+    """Starts mobile_commons_mock in its own process, so serving pages doesn't compete with the jobs"""
+
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "mobile_commons_mock.py",
+            "--port", str(port),
+            "--latency", str(args.latency),
+            "--jitter", str(args.jitter),
+            "--error-rate", str(args.error_rate),
+            "--max-concurrency", str(args.max_concurrency),
+            "--scale", str(args.scale),
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            mock_stats("http://127.0.0.1:{}/".format(port))
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("mock API didn't start")
+
+
+def run_jobs(args, url, summary):
+    """Runs mobile_commons_runner against the mock, returning its wall time, exit code and peak RSS in MB"""
+
+    env = dict(
+        os.environ,
+        MC_BASE_URL=url + "api/",
+        RUN_SUMMARY=summary,
+        TABLE_PREFIX=args.table_prefix,
+        FULL_REBUILD_FLAG="true" if args.mode == "full" else "false",
+    )
+
+    with open(args.log or os.devnull, "w") as log:
+        started = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, "mobile_commons_runner.py"] + args.jobs,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        # wait4 rather than wait, for the resource usage of this process (and its parse workers)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.monotonic() - started
+
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    return seconds, process.returncode, usage.ru_maxrss / 1024
+
+
+def previous_result(path, result):
+    """The last recorded run with the same jobs and settings, to compare against"""
+
+    if not os.path.exists(path):
+        return None
+
+    keys = ["jobs", "mode", "scale", "latency", "error_rate", "max_concurrency"]
+    previous = None
+
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if all(record.get(k) == result[k] for k in keys):
+                previous = record
+
+    return previous
+
+
+def bench_e2e(args):
+
+    server = None
+    url = args.url
+
+    if url is None:
+        port = free_port()
+        server = start_mock(args, port)
+        url = "http://127.0.0.1:{}/".format(port)
+
+    try:
+        before = mock_stats(url)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            summary_path = os.path.join(tmp, "summary.json")
+            seconds, exit_code, peak_rss = run_jobs(args, url, summary_path)
+
+            summary = {"jobs": {}}
+            if os.path.exists(summary_path):
+                with open(summary_path) as f:
+                    summary = json.load(f)
+
+        after = mock_stats(url)
+
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    served = {k: after[k] - before[k] for k in ("requests", "pages", "rows", "bytes", "throttled", "errors")}
+    rows = sum(job["rows"] for job in summary["jobs"].values())
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    result = {
+        "at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit or None,
+        "jobs": args.jobs,
+        "mode": args.mode,
+        "scale": args.scale,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "max_concurrency": args.max_concurrency,
+        "exit_code": exit_code,
+        "seconds": round(seconds, 3),
+        "pages_per_s": round(served["pages"] / seconds, 1),
+        "rows_per_s": round(rows / seconds, 1),
+        "rows": rows,
+        "peak_rss_mb": round(peak_rss, 1),
+        "served": served,
+        "stages": {job: stats["seconds"] for job, stats in summary["jobs"].items()},
+    }
+
+    previous = previous_result(args.results, result)
+
+    with open(args.results, "a") as f:
+        f.write(json.dumps(result) + "\n")
+
+    print(
+        "{} in {:.1f} s (exit code {}): {} pages, {:,.0f} pages/s, {} rows, {:,.0f} rows/s, peak RSS {:.0f} MB".format(
+            ", ".join(args.jobs),
+            seconds,
+            exit_code,
+            served["pages"],
+            result["pages_per_s"],
+            rows,
+            result["rows_per_s"],
+            peak_rss,
+        )
+    )
+    print("{requests} requests, {throttled} throttled, {errors} errors".format(**served))
+
+    for job, stages in result["stages"].items():
+        print("  {}: {}".format(job, ", ".join("{} {:.2f} s".format(k, v) for k, v in stages.items())))
+
+    if previous is not None:
+        print(
+            "Previous run ({}, {}): {:,.0f} rows/s, {:.1f} s, peak RSS {:.0f} MB".format(
+                previous["at"],
+                previous["commit"],
+                previous["rows_per_s"],
+                previous["seconds"],
+                previous["peak_rss_mb"],
+            )
+        )
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parse = subparsers.add_parser("parse", help="XML page parsing, legacy vs iterparse")
+    parse.add_argument("--rows", type=int, nargs="+", default=[500, 1000])
+    parse.add_argument("--number", type=int, default=20)
+    parse.set_defaults(func=bench_parse)
+
+    timestamps = subparsers.add_parser("timestamps", help="timestamp column parsing, old paths vs parse_timestamps")
+    timestamps.add_argument("--rows", type=int, default=1000000)
+    timestamps.add_argument("--unique", type=int, default=50000)
+    timestamps.add_argument("--legacy-rows", type=int, default=20000)
+    timestamps.add_argument("--repeat", type=int, default=1)
+    timestamps.set_defaults(func=bench_timestamps)
+
+    e2e = subparsers.add_parser("e2e", help="the real jobs end to end against the mock API")
+    e2e.add_argument("--jobs", nargs="+", default=["profiles", "broadcasts", "outgoing_messages"])
+    e2e.add_argument("--mode", choices=["full", "incremental"], default="full")
+    e2e.add_argument("--scale", type=float, default=1.0, help="multiplies the number of records served")
+    e2e.add_argument("--latency", type=float, default=0.05, help="seconds the mock takes per response")
+    e2e.add_argument("--jitter", type=float, default=0.05)
+    e2e.add_argument("--error-rate", type=float, default=0.0)
+    e2e.add_argument("--max-concurrency", type=int, default=80, help="requests in flight before the mock throttles")
+    e2e.add_argument("--url", help="an already running mock API, e.g. http://localhost:8770/")
+    e2e.add_argument("--table-prefix", default="mc_benchmark", help="TABLE_PREFIX the jobs load into")
+    e2e.add_argument("--results", default="benchmark_results.jsonl", help="file each run's numbers are appended to")
+    e2e.add_argument("--log", help="file for the jobs' output (default: discarded)")
+    e2e.set_defaults(func=bench_e2e)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+
+    main()
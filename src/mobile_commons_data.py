@@ -5,17 +5,17 @@ class columns:
     def __init__(self):
         self.columns = {
         	"profiles": {
-        		"id" : "float64",
+        		"id" : "Int64",
         		"first_name" : "str",
         		"last_name" : "str",
         		"phone_number" : "str",
         		"email" : "str",
-        		"status" : "str",
+        		"status" : "category",
         		"created_at" : "datetime64[ns, UTC]",
         		"updated_at" : "datetime64[ns, UTC]",
         		"opted_out_at" : "datetime64[ns, UTC]",
-        		"opted_out_source" : "str",
-            "source": "str",
+        		"opted_out_source" : "category",
+            "source": "category",
             "address" : "str",
             "last_saved_districts" : "str",
             "last_saved_location" : "str"
@@ -23,117 +23,117 @@ class columns:
         	},
 
         	"groups": {
-        		"id" : "float64",
-        		"type" : "str",
-        		"status" : "str",
+        		"id" : "Int64",
+        		"type" : "category",
+        		"status" : "category",
         		"name" : "str",
-        		"size" : "float64"
+        		"size" : "Int64"
         	},
 
         	"group_members": {
-        		"id" : "float64",
+        		"id" : "Int64",
         		"email" : "str",
         		"first_name" : "str",
         		"last_name" : "str",
-        		"status" : "str",
+        		"status" : "category",
         		"created_at" : "datetime64[ns, UTC]",
         		"opted_out_at" : "datetime64[ns, UTC]",
-        		"opted_out_source": "str",
-        		"group_id": "float64"
+        		"opted_out_source": "category",
+        		"group_id": "Int64"
         	},
 
         	"campaigns": {
-        		"id" : "float64",
+        		"id" : "Int64",
         		"name" : "str",
-        		"active" : "bool",
+        		"active" : "boolean",
         		"description" : "str" ,
         		"tags" : "str"
         	},
 
         	"campaign_subscribers": {
-        		"id" : "float64",
-        		"profile_id" : "float64",
+        		"id" : "Int64",
+        		"profile_id" : "Int64",
         		"phone_number" : "str",
         		"activated_at" : "datetime64[ns, UTC]",
         		"opted_out_at" : "datetime64[ns, UTC]",
-        		"campaign_id": "float64"
+        		"campaign_id": "Int64"
         	},
 
         	"messages": {
-        		"approved" : "bool",
-        		"id" : "float64",
-        		"type" : "str",
+        		"approved" : "boolean",
+        		"id" : "Int64",
+        		"type" : "category",
         		"body" : "str",
         		"campaign" : "str",
-        		"campaign_id": "float64",
-        		"carrier_name" : "str",
-        		"keyword" : "str",
-        		"message_template_id": "float64",
-        		"mms" : "bool",
-        		"multipart" : "bool",
-        		"next_id" : "str",
+        		"campaign_id": "Int64",
+        		"carrier_name" : "category",
+        		"keyword" : "category",
+        		"message_template_id": "Int64",
+        		"mms" : "boolean",
+        		"multipart" : "boolean",
+        		"next_id" : "Int64",
         		"phone_number" : "str",
-        		"previous_id" : "str",
-        		"profile" : "float64",
+        		"previous_id" : "Int64",
+        		"profile" : "Int64",
         		"received_at" : "datetime64[ns, UTC]"
         	},
 
         	"sent_messages": {
-        		"id" : "float64",
-        		"status" : "str",
-        		"type" : "str",
+        		"id" : "Int64",
+        		"status" : "category",
+        		"type" : "category",
         		"body" : "str",
         		"campaign" : "str",
-        		"campaign_id": "float64",
-        		"message_template_id" : "float64",
-        		"mms"  : "bool",
-        		"multipart" : "bool",
-        		"next_id" : "str",
+        		"campaign_id": "Int64",
+        		"message_template_id" : "Int64",
+        		"mms"  : "boolean",
+        		"multipart" : "boolean",
+        		"next_id" : "Int64",
         		"phone_number" : "str",
-        		"previous_id" : "str",
-        		"profile" : "float64",
+        		"previous_id" : "Int64",
+        		"profile" : "Int64",
         		"sent_at" : "datetime64[ns, UTC]"
         	},
 
         	"broadcasts": {
-        		"id" : "float64",
-        		"status" : "str",
-        		"automated" : "bool",
+        		"id" : "Int64",
+        		"status" : "category",
+        		"automated" : "boolean",
         		"body" : "str",
         		"campaign" : "str",
         		"delivery_time" : "datetime64[ns, UTC]",
-        		"estimated_recipients_count" : "float64",
+        		"estimated_recipients_count" : "Int64",
         		"excluded_groups" : "str",
-        		"include_subscribers" : "bool",
+        		"include_subscribers" : "boolean",
         		"included_groups" : "str",
-        		"localtime" : "bool",
+        		"localtime" : "boolean",
         		"name" : "str",
-        		"opt_outs_count" : "float64",
-        		"replies_count" : "float64",
+        		"opt_outs_count" : "Int64",
+        		"replies_count" : "Int64",
         		"tags" : "str",
-        		"throttled" : "bool"
+        		"throttled" : "boolean"
         	},
 
         	"tags": {
-        		"id" : "float64",
+        		"id" : "Int64",
         		"name" : "str",
-        		"taggable_object" : "str"
+        		"taggable_object" : "category"
 
         	},
 
         	"tinyurls": {
-        		"id" : "float64",
+        		"id" : "Int64",
         		"created_at" : "datetime64[ns, UTC]",
         		"description" : "str",
-        		"host" : "str",
+        		"host" : "category",
         		"key" : "str",
-        		"mode" : "str",
+        		"mode" : "category",
         		"name" : "str",
         		"url" : "str"
         	},
 
         	"clicks": {
-        		"id" : "float64",
+        		"id" : "Int64",
         		"clicked_url" : "str",
         		"created_at"  : "datetime64[ns, UTC]",
         		"http_referer" : "str",
@@ -143,3 +143,33 @@ class columns:
         	}
 
         }
+
+        # Longest value expected per column, sizes its warehouse VARCHAR and longer values are cut
+        # to fit. Everything else gets VARCHAR(65535). Kept to ASCII fields since Redshift counts bytes
+        self.lengths = {
+            "phone_number": 32,
+            "status": 64,
+            "type": 64,
+            "carrier_name": 128,
+            "opted_out_source": 128,
+            "taggable_object": 64,
+            "mode": 32,
+            "host": 256,
+            "key": 64,
+            "remote_addr": 64,
+        }
+
+        # Natural key per endpoint, used to replace existing rows when loading with LOAD_MODE=upsert
+        self.keys = {
+            "profiles": ["id"],
+            "groups": ["id"],
+            "group_members": ["id", "group_id"],
+            "campaigns": ["id"],
+            "campaign_subscribers": ["id", "campaign_id"],
+            "messages": ["id"],
+            "sent_messages": ["id"],
+            "broadcasts": ["id"],
+            "tags": ["id"],
+            "tinyurls": ["id"],
+            "clicks": ["id"],
+        }
@@ -0,0 +1,69 @@
+"""
+Process-wide SQLAlchemy engines. Every connection, watermark store and runner in a process
+shares one engine (and so one connection pool) per database, created on first use so that
+extraction alone never opens a warehouse connection
+"""
+
+import os
+import threading
+
+from sqlalchemy import create_engine
+
+DB_DATABASE = os.getenv("DB_DATABASE")
+DB_HOST = os.getenv("DB_HOST")
+DB_CREDENTIAL_USERNAME = os.getenv("DB_CREDENTIAL_USERNAME")
+DB_CREDENTIAL_PASSWORD = os.getenv("DB_CREDENTIAL_PASSWORD")
+DB_PORT = os.getenv("DB_PORT")
+
+# Pool shared by every load in the process, loads run in threads so a few connections suffice
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+# Redshift drops idle connections, so recycle them before that and ping before reuse
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+
+ENGINES = {}
+LOCK = threading.Lock()
+
+
+def warehouse_url():
+    """Connection URL of the warehouse described by the DB_* environment variables"""
+
+    return (
+        "postgresql://"
+        + DB_CREDENTIAL_USERNAME
+        + ":"
+        + DB_CREDENTIAL_PASSWORD
+        + "@"
+        + DB_HOST
+        + ":"
+        + DB_PORT
+        + "/"
+        + DB_DATABASE
+    )
+
+
+def get_engine(url=None, **kwargs):
+    """Shared engine for a database URL (the warehouse by default), created the first time it's asked for"""
+
+    url = url or warehouse_url()
+
+    with LOCK:
+        if url not in ENGINES:
+            ENGINES[url] = create_engine(
+                url,
+                pool_size=kwargs.get("pool_size", DB_POOL_SIZE),
+                max_overflow=kwargs.get("max_overflow", DB_MAX_OVERFLOW),
+                pool_recycle=kwargs.get("pool_recycle", DB_POOL_RECYCLE),
+                pool_pre_ping=kwargs.get("pool_pre_ping", True),
+            )
+
+        return ENGINES[url]
+
+
+def dispose_engines():
+    """Closes every pooled connection, e.g. at the end of a run"""
+
+    with LOCK:
+        for engine in ENGINES.values():
+            engine.dispose()
+        ENGINES.clear()
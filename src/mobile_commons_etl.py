@@ -1,29 +1,77 @@
 import pandas as pd
-import xmltodict
-import json
 import os
-import sys
+import io
+import gzip
+import uuid
 import math
+import time
 import datetime
-import pytz
-import dateparser
 import asyncio
 import aiohttp
 import numpy as np
 import sqlalchemy
 import mobile_commons_data as mcd
+import mobile_commons_parser as mcp
+import mobile_commons_limiter as mcl
+import mobile_commons_spool as mcs
+import mobile_commons_state as mcst
+import mobile_commons_engine as mce
+import mobile_commons_sink as mcsk
+import mobile_commons_schema as mcsc
+import mobile_commons_timestamps as mct
+import mobile_commons_metrics as mcm
+import mobile_commons_logging as mclg
+import mobile_commons_profiling as mcpr
+
+from concurrent.futures import ProcessPoolExecutor
+from pandas.api.types import union_categoricals
+
+# "insert" (multi-row INSERTs), "copy" (Postgres COPY FROM STDIN) or "s3_copy" (Redshift COPY via S3)
+LOAD_METHOD = os.getenv("LOAD_METHOD", "insert")
+LOAD_METHODS = ("insert", "copy", "s3_copy")
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_PREFIX = os.getenv("S3_PREFIX", "mobile_commons")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+REDSHIFT_IAM_ROLE = os.getenv("REDSHIFT_IAM_ROLE")
+AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
+AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+COPY_CHUNKSIZE = 100000
+
+# "append" or "upsert" (replace rows matching the endpoint's natural key) for incremental loads
+LOAD_MODE = os.getenv("LOAD_MODE", "append")
 
-from sqlalchemy import create_engine
+COLUMNS = mcd.columns()
 
-from pandas.io.json import json_normalize
+# Keep-alive pool settings for the shared aiohttp session
+POOL_SIZE = 80
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 60
+TIMEOUT = aiohttp.ClientTimeout(total=60 * 60)
 
-DB_DATABASE = os.getenv("DB_DATABASE")
-DB_HOST = os.getenv("DB_HOST")
-DB_CREDENTIAL_USERNAME = os.getenv("DB_CREDENTIAL_USERNAME")
-DB_CREDENTIAL_PASSWORD = os.getenv("DB_CREDENTIAL_PASSWORD")
-DB_PORT = os.getenv("DB_PORT")
+# Pages in flight (and parsed pages waiting downstream) when streaming
+BUFFER_SIZE = 80
+# Streamed pages are collated (and cast) this many at a time, so parsed pages never pile up
+COLLATE_PAGES = int(os.getenv("COLLATE_PAGES", 50))
+
+# Fetch-until-empty pagination: pages in flight, and how far past the last page known to
+# have records it may run ahead (which bounds the requests wasted past the end)
+SWEEP_WINDOW = 16
+SWEEP_OVERSHOOT = 16
+
+logger = mclg.get_logger("etl")
+
+
+def create_client_session(pool_size=POOL_SIZE):
+    """Keep-alive HTTP session, must be called from inside the event loop that will use it"""
+
+    connector = aiohttp.TCPConnector(
+        limit=pool_size,
+        limit_per_host=pool_size,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=TIMEOUT)
 
-COLUMNS = mcd.columns()
 
 class mobile_commons_connection:
     def __init__(self, endpoint, full_build, **kwargs):
@@ -31,13 +79,21 @@ class mobile_commons_connection:
         self.endpoint = endpoint
         self.full_build = full_build
         self.semaphore = kwargs.get("semaphore", None)
+        self.host_limiter = kwargs.get("host_limiter", None) or mcl.null_limiter()
         self.auth = kwargs.get("auth", None)
         self.limit = kwargs.get("limit", None)
         self.base = kwargs.get("base", None)
         self.endpoint_key = kwargs.get("endpoint_key", None)
         self.columns = COLUMNS.columns[endpoint]
+        self.parser = None
         self.page_count = kwargs.get("page_count", None)
-        self.session = kwargs.get("session", None)
+        self.client_session = kwargs.get("client_session", None)
+        self.pool_size = kwargs.get("pool_size", POOL_SIZE)
+        self.stream = kwargs.get("stream", False)
+        self.buffer_size = kwargs.get("buffer_size", BUFFER_SIZE)
+        self.collate_pages = kwargs.get("collate_pages", COLLATE_PAGES)
+        self.parse_workers = kwargs.get("parse_workers", None)
+        self.executor = kwargs.get("executor", None)
         self.user = kwargs.get("user", None)
         self.pw = kwargs.get("pw", None)
         self.base = kwargs.get("base", None)
@@ -49,23 +105,48 @@ class mobile_commons_connection:
         self.campaign_id = kwargs.get("campaign_id", None)
         self.url_id = kwargs.get("url_id", None)
         self.index = None
+        self.probes = {}
+        self.prefetched = {}
         self.index_id = self.group_id or self.url_id or self.campaign_id
         self.db_incremental_key = kwargs.get("db_incremental_key", None)
         self.schema = kwargs.get("schema", "public")
         self.table_prefix = kwargs.get("table_prefix", "")
-        self.sql_engine = create_engine(
-            "postgresql://"
-            + DB_CREDENTIAL_USERNAME
-            + ":"
-            + DB_CREDENTIAL_PASSWORD
-            + "@"
-            + DB_HOST
-            + ":"
-            + DB_PORT
-            + "/"
-            + DB_DATABASE
+        self.load_method = kwargs.get("load_method", LOAD_METHOD)
+        self.load_mode = kwargs.get("load_mode", LOAD_MODE)
+        # Checked up front, since write_table (re)creates the table before it gets to the load method
+        if self.load_method not in LOAD_METHODS:
+            raise ValueError(
+                f"Unknown load method {self.load_method}, expected one of {', '.join(LOAD_METHODS)}"
+            )
+        self.keys = COLUMNS.keys[endpoint]
+        self.spool_dir = kwargs.get("spool_dir", mcs.SPOOL_DIR)
+        self.spool = None
+        self.parquet_dir = kwargs.get("parquet_dir", mcsk.PARQUET_DIR)
+        self.metrics = kwargs.get("metrics", None) or mcm.METRICS
+        self.profiler = kwargs.get("profiler", None) or mcpr.profiler()
+        self.progress = None
+
+        if self.endpoint_key is not None:
+            self.parser = mcp.record_parser(
+                self.endpoint_key[0][endpoint],
+                self.endpoint_key[1][endpoint],
+                self.columns.keys(),
+            )
+
+        if (self.executor is None) & (self.parse_workers is not None):
+            self.executor = ProcessPoolExecutor(max_workers=self.parse_workers)
+
+        # Left unset, the process-wide warehouse engine is only created once something queries it
+        self.engine = kwargs.get("sql_engine", None)
+        self.watermarks = kwargs.get("watermarks", None) or mcst.watermark_store(
+            self.engine, self.schema, self.table_prefix
         )
 
+    @property
+    def sql_engine(self):
+
+        return self.engine or mce.get_engine()
+
     async def get_page(self, page, retries=5, **kwargs):
         """Base asynchronous request function"""
 
@@ -86,10 +167,24 @@ class mobile_commons_connection:
         if self.limit is not None:
             params["limit"] = self.limit
 
+        spool = self.get_spool()
+        if spool is not None:
+            with self.metrics.timer("spool", self.endpoint, self.index_id) as measured:
+                data = await spool.read(page)
+                measured["bytes"] = len(data or b"")
+            if data is not None:
+                try:
+                    mcp.check_response(data)
+                    return data
+                except mcp.response_error:
+                    # Spooled by an older run that didn't check pages, fetch it again
+                    logger.info("Discarding bad spooled page %s", page, extra=self.log_fields(page=page))
+                    spool.discard(page)
+
         url = f"{self.base}{self.endpoint}"
-        print(f"Fetching page {page}")
+        logger.debug("Fetching page %s", page, extra=self.log_fields(page=page))
 
-        TIMEOUT = aiohttp.ClientTimeout(total=60 * 60)
+        session = self.get_client_session()
 
         attempts = 1
         data = None
@@ -97,24 +192,165 @@ class mobile_commons_connection:
         while data is None or attempts <= retries:
 
             try:
-                async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
-                    async with self.semaphore, session.get(
-                        url, params=params, auth=self.auth
-                    ) as resp:
-                        resp.raise_for_status()
-                        print(f"{resp.url} status: {resp.status}")
-                        data = await resp.text()
-                        return data
-
-            except aiohttp.ClientError:
-                print(f"Retrying {page}...")
+                async with self.semaphore, self.host_limiter:
+                    started = time.monotonic()
+                    stalls = self.stalls()
+                    waited = None
+                    status = None
+
+                    try:
+                        async with session.get(
+                            url, params=params, auth=self.auth
+                        ) as resp:
+                            # The limiter judges the server by its response time, not by how
+                            # long the body takes to read on a busy event loop
+                            waited = time.monotonic() - started
+                            stalled = self.stalls() - stalls
+                            status = resp.status
+                            resp.raise_for_status()
+                            data = await resp.read()
+                            logger.debug(
+                                "%s status: %s", resp.url, resp.status, extra=self.log_fields(page=page)
+                            )
+                    except asyncio.CancelledError:
+                        # Says nothing about the server, e.g. a sweep dropping pages past the end
+                        status = "cancelled"
+                        raise
+                    finally:
+                        latency = time.monotonic() - started
+                        if waited is None:
+                            waited, stalled = latency, self.stalls() - stalls
+                        if status != "cancelled":
+                            self.observe(waited, status, stalled)
+                        self.metrics.request(
+                            self.endpoint, self.index_id, latency, status, bytes=len(data or b"")
+                        )
+
+                # Only pages that pass are spooled, a bad one would otherwise be replayed on every retry
+                mcp.check_response(data)
+
+                if spool is not None:
+                    await spool.write(page, data)
+
+                self.update_progress(bytes=len(data))
+
+                return data
+
+            except (aiohttp.ClientError, mcp.response_error) as e:
+                if isinstance(e, mcp.response_error) and (attempts >= retries):
+                    # Failing the job beats loading around a hole and moving the watermark past it
+                    raise
+                data = None
+                # Counted in the progress lines, only a page that keeps failing is worth a warning
+                log = logger.warning if attempts >= retries else logger.debug
+                log("Retrying page %s after %r", page, e, extra=self.log_fields(page=page, attempt=attempts))
+                self.metrics.retry(self.endpoint, self.index_id)
+                self.update_progress(count=0, retries=1)
                 attempts += 1
                 await asyncio.sleep(1)
 
+    def log_fields(self, **kwargs):
+        """Structured fields identifying this result set (and e.g. the page) in log records"""
+
+        fields = {"endpoint": self.endpoint}
+
+        if self.index_id is not None:
+            fields["parent"] = self.index_id
+
+        fields.update(kwargs)
+
+        return fields
+
+    def update_progress(self, count=1, bytes=0, retries=0):
+        """Counts fetched pages, logging a progress line every so often instead of a line per page"""
+
+        if self.progress is None:
+            label = str.upper(self.endpoint)
+            if self.index_id is not None:
+                label = "{} {} {}".format(label, self.index or "parent", self.index_id)
+            self.progress = mclg.progress(logger, label, fields=self.log_fields())
+
+        self.progress.total = self.page_count
+        self.progress.update(count, bytes=bytes, retries=retries)
+
+    def get_spool(self):
+        """Page spool for this result set when a spool directory is configured, otherwise None"""
+
+        if (self.spool is None) & (self.spool_dir is not None):
+            watermark = None if self.full_build else self.last_timestamp
+            self.spool = mcs.page_spool(
+                self.spool_dir, self.endpoint, parent=self.index_id, watermark=watermark
+            )
+
+        return self.spool
+
+    def clear_spool(self):
+        """Drops the spooled pages once they're loaded (or there was nothing to load)"""
+
+        if self.spool is not None:
+            self.spool.clear()
+
+    def observe(self, latency, status, stalled=0.0):
+        """Reports a request's latency and status back to the limiter if it adapts to them"""
+
+        if hasattr(self.semaphore, "observe"):
+            self.semaphore.observe(latency, status, self.endpoint, stalled)
+
+    def stalls(self):
+        """Seconds the event loop has stalled so far, as the limiter counts them (0 if it doesn't)"""
+
+        if hasattr(self.semaphore, "stalls"):
+            return self.semaphore.stalls()
+
+        return 0.0
+
+    def get_client_session(self):
+        """Returns the pooled HTTP session, creating it on first use inside the event loop"""
+
+        if self.client_session is None or self.client_session.closed:
+            self.client_session = create_client_session(self.pool_size)
+
+        return self.client_session
+
+    def open_client_session(self):
+        """Opens the pooled HTTP session so it can be handed to child connections"""
+
+        async def opener():
+            return self.get_client_session()
+
+        loop = asyncio.get_event_loop()
+        return loop.run_until_complete(opener())
+
+    def close(self):
+        """Closes the pooled HTTP session and parse workers shared by this connection and its children"""
+
+        if self.client_session is not None and not self.client_session.closed:
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(self.client_session.close())
+
+        if self.executor is not None:
+            self.executor.shutdown()
+
     def ping_endpoint(self, **kwargs):
         """Wrapper for asynchronous calls that then have results collated into a dataframe"""
 
         loop = asyncio.get_event_loop()
+        return loop.run_until_complete(self.ping_endpoint_async(**kwargs))
+
+    async def ping_endpoint_async(self, **kwargs):
+        """Fetches every page of the result set and collates them into a dataframe"""
+
+        # Pages already parsed while probing for the page count aren't fetched again
+        prefetched = [
+            page_result
+            for page, page_result in self.prefetched.items()
+            if page <= self.page_count
+        ]
+
+        if self.stream:
+            chunks = [self.collate(prefetched)] if len(prefetched) > 0 else []
+            chunks += await self.collect_pages(self.pages_to_fetch(), **kwargs)
+            return self.combine(chunks)
 
         # Chunks async calls into bundles if page count is greater than 500
 
@@ -135,46 +371,280 @@ class mobile_commons_connection:
 
         for b in range(1, len(breaks)):
 
-            temp = loop.run_until_complete(
-                asyncio.gather(
-                    *(
-                        self.get_page(page, **kwargs)
-                        for page in range(breaks[b - 1], breaks[b])
-                    )
+            temp = await asyncio.gather(
+                *(
+                    self.get_page(page, **kwargs)
+                    for page in range(breaks[b - 1], breaks[b])
+                    if page not in self.prefetched
                 )
             )
             res += temp
 
-        endpoint_key_0 = self.endpoint_key[0][self.endpoint]
-        endpoint_key_1 = self.endpoint_key[1][self.endpoint]
+        res_list = await asyncio.gather(*(self.parse_page_async(r) for r in res))
+        del res
 
-        res_list = []
+        return self.collate(prefetched + [r for r in res_list if r is not None])
 
-        for r in res:
-            try:
-                if (
-                    json.loads(json.dumps(xmltodict.parse(r))).get("response")
-                    is not None
-                ):
-                    json_xml = json.loads(json.dumps(xmltodict.parse(r)))
-                    page_result = json_normalize(
-                        json_xml["response"][endpoint_key_1][endpoint_key_0],
-                        max_level=0,
-                    )
-                    res_list.append(page_result)
-            except:
-                print("Improperly formatted XML response... skipping")
-                continue
+    def pages_to_fetch(self):
+        """Pages of the result set that weren't already parsed while probing"""
 
-        df_agg = pd.concat(res_list, sort=True, join="outer")
-        df_agg.columns = [
-            c.replace(".", "_").replace("@", "").replace("@_", "").replace("_@", "")
-            for c in df_agg.columns
+        return [
+            page
+            for page in range(1, self.page_count + 1)
+            if page not in self.prefetched
         ]
-        df_agg = df_agg.loc[:, df_agg.columns.isin(list(self.columns.keys()))]
-        return df_agg
+
+    async def stream_pages(self, pages, **kwargs):
+        """
+        Fetches pages with at most buffer_size in flight and yields each one parsed as
+        soon as it arrives, so raw responses never pile up in memory
+        """
+
+        queue = asyncio.Queue(maxsize=self.buffer_size)
+        pending = iter(pages)
+        finished = object()
+        errors = []
+
+        async def worker():
+            try:
+                for page in pending:
+                    r = await self.get_page(page, **kwargs)
+                    page_result = await self.parse_page_async(r)
+                    del r
+                    if page_result is not None:
+                        await queue.put(page_result)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                await queue.put(finished)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.buffer_size)]
+        remaining = len(workers)
+
+        try:
+            while remaining > 0:
+                item = await queue.get()
+                if item is finished:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            for w in workers:
+                w.cancel()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    async def collect_pages(self, pages, **kwargs):
+        """
+        Drains stream_pages, collating every collate_pages parsed pages into a chunk as they
+        arrive. Chunks are cast to the declared dtypes and much smaller than the pages they hold
+        """
+
+        chunks = []
+        batch = []
+
+        async for page_result in self.stream_pages(pages, **kwargs):
+            batch.append(page_result)
+            if len(batch) >= self.collate_pages:
+                chunks.append(self.collate(batch))
+                batch = []
+
+        if len(batch) > 0:
+            chunks.append(self.collate(batch))
+
+        return chunks
+
+    async def sweep_endpoint_async(self, window=SWEEP_WINDOW, overshoot=SWEEP_OVERSHOOT, **kwargs):
+        """
+        Fetches pages in order with up to `window` in flight until one comes back empty (or short
+        of the page size), without knowing the page count up front. Page 1 goes out alone, so an
+        empty or single-page result set costs one request, and the pages requested past the last
+        one known to have records then double with every full page, up to `overshoot`. Whatever
+        comes back past the end is discarded. Sets page_count to the pages kept
+        """
+
+        condition = asyncio.Condition()
+        results = {}
+        errors = []
+        state = {"next": 1, "end": self.max_pages + 1, "frontier": 0}
+
+        def can_issue():
+            ahead = min(overshoot, max(state["frontier"], 1))
+            return (state["next"] >= state["end"]) or (state["next"] <= state["frontier"] + ahead)
+
+        async def worker():
+            try:
+                while True:
+                    async with condition:
+                        await condition.wait_for(lambda: can_issue() or (len(errors) > 0))
+                        if (state["next"] >= state["end"]) or (len(errors) > 0):
+                            return
+                        page = state["next"]
+                        state["next"] += 1
+
+                    r = await self.get_page(page, **kwargs)
+
+                    try:
+                        parsed = await self.parse_async(r)
+                    except mcp.response_error:
+                        raise
+                    except Exception:
+                        # A malformed page doesn't say where the end is, so keep going past it
+                        logger.warning(
+                            "Improperly formatted XML response... skipping",
+                            extra=self.log_fields(page=page),
+                        )
+                        parsed = None
+                    del r
+
+                    async with condition:
+                        if parsed is None:
+                            state["frontier"] = max(state["frontier"], page)
+                        elif parsed[1] == 0:
+                            state["end"] = min(state["end"], page)
+                        else:
+                            state["frontier"] = max(state["frontier"], page)
+                            results[page] = self.to_frame(parsed)
+                            if (self.limit is not None) and (parsed[1] < int(self.limit)):
+                                state["end"] = min(state["end"], page + 1)
+                        condition.notify_all()
+
+            except Exception as e:
+                async with condition:
+                    errors.append(e)
+                    condition.notify_all()
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(window)]
+
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+
+        if len(errors) > 0:
+            raise errors[0]
+
+        # Pages at or past the first empty one are overshoot
+        kept = sorted(page for page in results if page < state["end"])
+        self.page_count = max(kept, default=0)
+        res_list = [results[page] for page in kept if results[page] is not None]
+
+        if len(res_list) == 0:
+            return None
+
+        return self.collate(res_list)
+
+    def parse_page(self, r):
+        """Parses a single XML response into a dataframe of records, or None if it has none"""
+
+        try:
+            with self.metrics.timer("parse", self.endpoint, self.index_id) as measured:
+                measured["bytes"] = len(r)
+                parsed = self.parser.parse(r)
+                measured["rows"] = parsed[1]
+        except mcp.response_error:
+            raise
+        except Exception:
+            logger.warning("Improperly formatted XML response... skipping", extra=self.log_fields())
+            return None
+
+        return self.to_frame(parsed)
+
+    async def parse_page_async(self, r):
+        """Parses a response in the process pool when there is one, otherwise inline"""
+
+        try:
+            parsed = await self.parse_async(r)
+        except mcp.response_error:
+            raise
+        except Exception:
+            logger.warning("Improperly formatted XML response... skipping", extra=self.log_fields())
+            return None
+
+        return self.to_frame(parsed)
+
+    async def parse_async(self, r):
+        """Column arrays, record count and metadata of a response, parsed off the event loop if possible"""
+
+        with self.metrics.timer("parse", self.endpoint, self.index_id) as measured:
+            measured["bytes"] = len(r)
+
+            if self.executor is None:
+                parsed = self.parser.parse(r)
+            else:
+                loop = asyncio.get_event_loop()
+                parsed = await loop.run_in_executor(self.executor, self.parser.parse, r)
+
+            measured["rows"] = parsed[1]
+
+        return parsed
+
+    def to_frame(self, parsed):
+        """Builds a dataframe from the column arrays returned by the parser"""
+
+        cols, rows, meta = parsed
+
+        if (rows == 0) | (len(cols) == 0):
+            return None
+
+        return pd.DataFrame(cols)
+
+    def collate(self, res_list):
+        """Concatenates parsed pages and keeps only the columns mapped for the endpoint"""
+
+        with self.metrics.timer("collate", self.endpoint, self.index_id) as measured:
+            df_agg = pd.concat(res_list, sort=True, join="outer")
+            df_agg.columns = [
+                c.replace(".", "_").replace("@", "").replace("@_", "").replace("_@", "")
+                for c in df_agg.columns
+            ]
+            df_agg = df_agg.loc[:, df_agg.columns.isin(list(self.columns.keys()))]
+            measured["rows"] = df_agg.shape[0]
+
+        return self.apply_schema(df_agg)
+
+    def combine(self, chunks):
+        """Concatenates collated chunks, unioning categories first so those columns stay categorical"""
+
+        if len(chunks) == 0:
+            return None
+
+        if len(chunks) == 1:
+            return chunks[0]
+
+        for c in set.intersection(*(set(chunk.columns) for chunk in chunks)):
+            if all(isinstance(chunk[c].dtype, pd.CategoricalDtype) for chunk in chunks):
+                categories = union_categoricals([chunk[c] for chunk in chunks]).categories
+                for chunk in chunks:
+                    chunk[c] = chunk[c].cat.set_categories(categories)
+
+        with self.metrics.timer("collate", self.endpoint, self.index_id) as measured:
+            df_agg = pd.concat(chunks, sort=True, join="outer")
+            measured["rows"] = df_agg.shape[0]
+
+        # Anything a chunk lacked comes back as object, cast it again
+        return self.apply_schema(df_agg)
 
     def get_latest_record(self, endpoint):
+        """
+        Latest timestamp loaded for this endpoint (and parent), from the watermark table.
+        Scans the target table only the first time, recording what it finds
+        """
+
+        parent = mcst.NO_PARENT if self.index is None else self.index_id
+
+        with self.metrics.timer("watermarks", endpoint, parent):
+            found, latest_date = self.watermarks.get(endpoint, parent)
+
+            if not found:
+                latest_date = self.scan_latest_record(endpoint)
+                self.watermarks.set(endpoint, {parent: latest_date})
+
+        return latest_date
+
+    def scan_latest_record(self, endpoint):
         """Pulls the latest record from the database to use for incremental updates"""
 
         table = f"{self.schema}.{self.table_prefix}_{endpoint}"
@@ -186,41 +656,93 @@ class mobile_commons_connection:
             )
 
         sql = (
-            """select to_timestamp(max(case when """
-            + self.db_incremental_key
-            + """ = 'None' or """
-            + self.db_incremental_key
-            + """ = 'nan' then null else """
-            + self.db_incremental_key
-            + """::timestamp end),'YYYY-MM-DD HH24:MI:SS TZ') as latest_date from {}""".format(table)
+            """select """
+            + self.latest_expression()
+            + """ as latest_date from {}""".format(table)
             + index_filter
         )
 
         date = pd.read_sql(sql, self.sql_engine)
 
-        if (date.shape[0] > 0) & (date["latest_date"][0] is not None):
-            latest_date = str(date["latest_date"][0])
-            utc = pytz.timezone("UTC")
-            dateparser.parse(latest_date).astimezone(utc).isoformat()
+        if (date.shape[0] > 0) and not pd.isnull(date["latest_date"][0]):
+            latest_date = str(mct.parse_timestamps(date["latest_date"])[0])
         else:
             latest_date = None
 
         return latest_date
 
-    def fetch_latest_timestamp(self):
-        """Handler for pulling latest record if incremental build"""
+    def latest_expression(self):
+        """SQL for the latest db_incremental_key, skipping the 'None'/'nan' strings older loads left"""
+
+        # Cast through varchar so it works whether the column was loaded as text or timestamptz
+        return (
+            """max(case when """
+            + self.db_incremental_key
+            + """::varchar in ('None', 'nan', 'NaT', '') then null else """
+            + self.db_incremental_key
+            + """::varchar::timestamptz end)"""
+        )
+
+    def get_latest_records(self, endpoint, parents):
+        """
+        Latest timestamps of every given campaign/group/tinyurl of a child endpoint at once, keyed
+        like the watermark table. Parents missing from it are bootstrapped with one group by scan
+        """
+
+        with self.metrics.timer("watermarks", endpoint) as measured:
+            watermarks = self.watermarks.get_all(endpoint)
+            missing = [p for p in parents if mcst.parent_key(p) not in watermarks]
+
+            if len(missing) > 0:
+                scanned = self.scan_latest_records(endpoint)
+                bootstrap = {mcst.parent_key(p): scanned.get(mcst.parent_key(p)) for p in missing}
+                self.watermarks.set(endpoint, bootstrap)
+                watermarks.update(bootstrap)
+
+            measured["rows"] = len(watermarks)
+
+        return watermarks
+
+    def scan_latest_records(self, endpoint):
+        """Latest record of every parent in the target table, in a single query grouped by index"""
+
+        table = f"{self.schema}.{self.table_prefix}_{endpoint}"
+
+        sql = (
+            """select """
+            + self.index
+            + """ as parent_id, """
+            + self.latest_expression()
+            + """ as latest_date from {} group by 1""".format(table)
+        )
 
-        if (not self.full_build) & (self.db_incremental_key is not None):
+        dates = pd.read_sql(sql, self.sql_engine)
 
-            print(
-                "Getting latest record for endpoint {}...".format(
-                    str.upper(self.endpoint)
-                ),
-                flush=True,
-                file=sys.stdout,
+        return {
+            mcst.parent_key(row.parent_id): str(row.latest_date)
+            for row in dates.itertuples()
+            if not pd.isnull(row.latest_date)
+        }
+
+    def fetch_latest_timestamp(self, watermarks=None):
+        """
+        Handler for pulling latest record if incremental build. Child connections can pass the
+        map from get_latest_records to skip the per-parent lookup
+        """
+
+        if (not self.full_build) & (self.db_incremental_key is not None) & (watermarks is not None):
+            self.last_timestamp = watermarks.get(mcst.parent_key(self.index_id))
+            logger.debug("Latest timestamp: %s", self.last_timestamp, extra=self.log_fields())
+
+        elif (not self.full_build) & (self.db_incremental_key is not None):
+
+            logger.debug(
+                "Getting latest record for endpoint %s...",
+                str.upper(self.endpoint),
+                extra=self.log_fields(),
             )
             self.last_timestamp = self.get_latest_record(self.endpoint)
-            print(f"Latest timestamp: {self.last_timestamp}")
+            logger.info("Latest timestamp: %s", self.last_timestamp, extra=self.log_fields())
 
         else:
             self.last_timestamp = None
@@ -228,124 +750,328 @@ class mobile_commons_connection:
 
         return self.last_timestamp
 
-    def page_count_get(self, page, **kwargs):
+    async def page_count_probe(self, page):
+        """Reads the page count off a page through the shared pool, memoized so no page is requested twice"""
+
+        if page not in self.probes:
+            self.probes[page] = asyncio.ensure_future(self.probe_page(page))
+
+        return await self.probes[page]
+
+    async def probe_page(self, page):
         """
-        Returns metadata around whether a request has non-zero result set
-        since endpoints are paginated but page count isn't always given
+        Reads the page count off a page, keeping its parsed records so ping_endpoint doesn't
+        have to fetch the page again
         """
 
-        endpoint_key_0 = self.endpoint_key[0][self.endpoint]
-        endpoint_key_1 = self.endpoint_key[1][self.endpoint]
+        r = await self.get_page(page)
+        parsed = await self.parse_async(r)
+        cols, rows, meta = parsed
 
-        params = {"page": page}
+        page_result = self.to_frame(parsed)
+        if page_result is not None:
+            self.prefetched[page] = page_result
 
-        if self.limit is not None:
-            params["limit"] = self.limit
+        ### Sina: 7/20/20 only broadcasts, messages, & sent_messages endpoints have page_count field this at this point in time
+        if meta.get("page_count") is not None:
+            return int(meta["page_count"])
 
-        if (self.api_incremental_key is not None) & (self.last_timestamp is not None):
-            params[self.api_incremental_key] = self.last_timestamp
+        elif rows > 0:
+            return 1
 
-        if self.group_id is not None:
-            params["group_id"] = self.group_id
+        else:
+            return 0
 
-        if self.campaign_id is not None:
-            params["campaign_id"] = self.campaign_id
+    def map_dtypes(self, value, length=None):
 
-        if self.url_id is not None:
-            params["url_id"] = self.url_id
+        return mcsc.sql_type(value, length)
 
-        resp = self.session.get(
-            self.base + self.endpoint, auth=(self.user, self.pw), params=params
-        )
+    def apply_schema(self, df):
+        """Casts a frame to the endpoint's declared dtypes, shrinking it well below object columns of strings"""
 
-        print(f"{resp.url}")
+        with self.metrics.timer("cast", self.endpoint, self.index_id) as measured:
+            measured["rows"] = df.shape[0]
+            return mcsc.apply_schema(df, self.columns, COLUMNS.lengths)
 
-        formatted_response = json.loads(json.dumps(xmltodict.parse(resp.text)))[
-            "response"
-        ][endpoint_key_1]
+    def load(self, df, endpoint):
+        """Loads to database"""
 
-        ### Sina: 7/20/20 only broadcasts, messages, & sent_messages endpoints have page_count field this at this point in time
-        if formatted_response.get("@page_count") is not None:
-            num_results = int(formatted_response.get("@page_count"))
+        with self.profiler.region(endpoint, "load"):
+            df, mapper = self.prepare(df)
+            table = self.table_name(endpoint)
 
-        elif formatted_response.get("page_count") is not None:
-            num_results = int(formatted_response.get("page_count"))
+            if self.full_build:
+                self.write_table(df, table, "replace", mapper)
+            elif self.load_mode == "upsert":
+                self.upsert(df, table, mapper)
+            else:
+                self.write_table(df, table, "append", mapper)
 
-        elif formatted_response.get(endpoint_key_0) is not None:
-            num_results = 1
+            self.record_watermarks(df, endpoint)
 
-        else:
-            num_results = 0
+    def changed_column_types(self, endpoint):
+        """
+        Columns of the existing table whose type no longer matches the declared one (e.g. text
+        loaded before the dtypes were declared), as {column: (existing, declared)}
+        """
 
-        return num_results
+        table = self.table_name(endpoint)
+        inspector = sqlalchemy.inspect(self.sql_engine)
 
-    def get_page_count(self, **kwargs):
-        """Binary search to find page count for an endpoint if page count data isn't available so we can parallelize downstream"""
+        if not inspector.has_table(table, schema=self.schema):
+            return {}
 
-        guess = math.floor((self.min_pages + self.max_pages) / 2)
-        diff = self.max_pages - self.min_pages
+        changed = {}
 
-        print(f"Page count guess: {guess}")
-        kwargs["page"] = guess
+        for column in inspector.get_columns(table, schema=self.schema):
+            name = column["name"]
+            if name not in self.columns:
+                continue
 
-        if (self.page_count_get(**kwargs) > 0) & (diff > 1):
-            self.min_pages = guess
-            return self.get_page_count(**kwargs)
+            existing = mcsc.type_family(column["type"])
+            declared = mcsc.type_family(self.map_dtypes(self.columns[name], COLUMNS.lengths.get(name)))
+            if existing != declared:
+                changed[name] = (existing, declared)
 
-        elif (self.page_count_get(**kwargs) == 0) & (diff > 1):
-            self.max_pages = guess
-            return self.get_page_count(**kwargs)
+        return changed
 
-        else:
-            print(f"Page count converged! Final count: {guess}")
-            return guess
-
-    def map_dtypes(self, value):
-
-        if value == "int64":
-            return sqlalchemy.types.BIGINT()
-        elif value == "str":
-            return sqlalchemy.types.NVARCHAR(length=65535)
-        elif value == "float64":
-            return sqlalchemy.types.Float(asdecimal=True)
-        elif value == "datetime64[ns, <tz>]":
-            return sqlalchemy.types.DateTime(timezone=True)
-        elif value == "bool":
-            return sqlalchemy.types.BOOLEAN()
-        else:
-            return sqlalchemy.types.NVARCHAR(length=65535)
+    def prepare(self, df):
+        """Frame cast to the declared dtypes and the warehouse column types to load it with"""
 
-    def load(self, df, endpoint):
-        """Loads to database"""
+        mapper = {k: self.map_dtypes(v, COLUMNS.lengths.get(k)) for k, v in self.columns.items()}
+        return self.apply_schema(df), mapper
+
+    def table_name(self, endpoint):
+
+        return f"{self.table_prefix}_{endpoint}"
 
-        mapper = {k: self.map_dtypes(v) for k, v in self.columns.items()}
-        df = df.replace({None: np.nan})
-        x = set(df.columns)
-        y = set(self.columns.keys())
-        final_cols = {i: self.columns[i] for i in x.intersection(y)}
-        df = df.astype(final_cols)
-
-        if self.full_build:
-
-            df.to_sql(
-                f"{self.table_prefix}_{endpoint}",
-                self.sql_engine,
-                schema=self.schema,
-                if_exists="replace",
-                index=False,
-                dtype=mapper,
-                method="multi",
-                chunksize=10000,
+    def write_parquet(self, df, endpoint, staging=None):
+        """
+        Lands a batch in the Parquet dataset when a parquet_dir is configured, partitioned by parent
+        for child endpoints. With a staging directory the batch waits there until it's published
+        """
+
+        if self.parquet_dir is None:
+            return 0
+
+        index = self.index if (self.index is not None) and (self.index in df.columns) else None
+
+        with self.metrics.timer("parquet", endpoint, self.index_id) as measured:
+            rows = mcsk.parquet_sink(self.parquet_dir).write(
+                df, endpoint, self.columns, index=index, staging=staging
             )
+            measured["rows"] = rows
+
+        logger.info(
+            "Wrote %s rows from endpoint %s to %s",
+            rows,
+            str.upper(endpoint),
+            staging or self.parquet_dir,
+            extra=self.log_fields(rows=rows),
+        )
+
+        return rows
+
+    def record_watermarks(self, df, endpoint):
+        """Advances the watermarks to the latest timestamps just loaded, per parent for child endpoints"""
+
+        if (self.db_incremental_key is None) or (self.db_incremental_key not in df.columns):
+            return
+
+        with self.metrics.timer("watermarks", endpoint, self.index_id) as measured:
+            watermarks = self.latest_watermarks(df)
+            # A full build replaced the table, so marks of parents it no longer holds go too
+            self.watermarks.set(endpoint, watermarks, replace=self.full_build)
+            measured["rows"] = len(watermarks)
+
+    def latest_watermarks(self, df):
+        """Latest db_incremental_key in a frame, keyed by parent id (None if the endpoint has no key)"""
+
+        if (self.db_incremental_key is None) or (self.db_incremental_key not in df.columns):
+            return None
 
+        latest = mct.parse_timestamps(df[self.db_incremental_key])
+
+        if (self.index is not None) and (self.index in df.columns):
+            return latest.groupby(df[self.index]).max().to_dict()
+
+        return {mcst.NO_PARENT: latest.max()}
+
+    def write_table(self, df, table, if_exists, mapper):
+        """Writes a dataframe to a table using the configured load method"""
+
+        with self.metrics.timer("load", self.endpoint, self.index_id) as measured:
+            measured["rows"] = df.shape[0]
+            measured["bytes"] = df.memory_usage(deep=True).sum()
+
+            if self.load_method == "insert":
+
+                df.to_sql(
+                    table,
+                    self.sql_engine,
+                    schema=self.schema,
+                    if_exists=if_exists,
+                    index=False,
+                    dtype=mapper,
+                    method="multi",
+                    chunksize=10000,
+                )
+
+            else:
+
+                # Creates (or replaces) the table with the mapped column types, then bulk loads rows
+                df.head(0).to_sql(
+                    table,
+                    self.sql_engine,
+                    schema=self.schema,
+                    if_exists=if_exists,
+                    index=False,
+                    dtype=mapper,
+                )
+
+                if self.load_method == "copy":
+                    self.copy_from_stdin(df, table)
+                else:
+                    self.copy_from_s3(df, table)
+
+    def upsert(self, df, table, mapper):
+        """
+        Loads into a staging table, then deletes rows sharing the endpoint's natural key
+        from the target and inserts the staged rows in a single transaction
+        """
+
+        keys = [k for k in self.keys if k in df.columns]
+        if len(keys) == 0:
+            raise ValueError(f"No natural key columns for endpoint {self.endpoint}")
+
+        df = df.drop_duplicates(subset=keys, keep="last")
+        staging = f"{table}_staging_{uuid.uuid4().hex[:8]}"
+
+        target = f'{self.schema}."{table}"'
+        source = f'{self.schema}."{staging}"'
+        cols = ", ".join('"' + c + '"' for c in df.columns)
+        match = " and ".join(f'{target}."{k}" = {source}."{k}"' for k in keys)
+
+        # Creates the target with the mapped types if this is its first load
+        df.head(0).to_sql(
+            table,
+            self.sql_engine,
+            schema=self.schema,
+            if_exists="append",
+            index=False,
+            dtype=mapper,
+        )
+
+        try:
+            self.write_table(df, staging, "replace", mapper)
+
+            with self.metrics.timer("merge", self.endpoint, self.index_id) as measured:
+                measured["rows"] = df.shape[0]
+
+                with self.sql_engine.begin() as conn:
+                    conn.execute(
+                        sqlalchemy.text(f"delete from {target} using {source} where {match}")
+                    )
+                    conn.execute(
+                        sqlalchemy.text(
+                            f"insert into {target} ({cols}) select {cols} from {source}"
+                        )
+                    )
+
+        finally:
+            with self.sql_engine.begin() as conn:
+                conn.execute(sqlalchemy.text(f"drop table if exists {source}"))
+
+    def copy_statement(self, df, table):
+        """Target of a COPY statement, i.e. the qualified table and its column list"""
+
+        cols = ", ".join('"' + c + '"' for c in df.columns)
+        return f'{self.schema}."{table}" ({cols})'
+
+    def copy_from_stdin(self, df, table):
+        """Bulk loads a dataframe into Postgres with COPY FROM STDIN, one transaction per call"""
+
+        sql = f"copy {self.copy_statement(df, table)} from stdin with (format csv)"
+
+        conn = self.sql_engine.raw_connection()
+
+        try:
+            cursor = conn.cursor()
+
+            for start in range(0, df.shape[0], COPY_CHUNKSIZE):
+                buf = io.StringIO()
+                df.iloc[start : start + COPY_CHUNKSIZE].to_csv(
+                    buf, index=False, header=False
+                )
+                buf.seek(0)
+                cursor.copy_expert(sql, buf)
+
+            conn.commit()
+
+        except Exception:
+            conn.rollback()
+            raise
+
+        finally:
+            conn.close()
+
+    def copy_from_s3(self, df, table):
+        """Stages a dataframe as gzipped CSV parts in S3 and loads them into Redshift with COPY"""
+
+        s3, prefix, keys = self.stage_s3(df, table)
+
+        try:
+            with self.sql_engine.begin() as conn:
+                conn.execute(sqlalchemy.text(self.s3_copy_sql(df, table, prefix)))
+
+        finally:
+            self.unstage_s3(s3, keys)
+
+    def stage_s3(self, df, table):
+        """Uploads a dataframe as gzipped CSV parts under a fresh prefix, returning the client, prefix and keys"""
+
+        # Only s3_copy needs boto3, insert and copy loads run without it
+        import boto3
+
+        s3 = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL)
+        prefix = f"{S3_PREFIX}/{self.schema}/{table}/{uuid.uuid4().hex}/"
+        keys = []
+
+        try:
+            for part, start in enumerate(range(0, df.shape[0], COPY_CHUNKSIZE)):
+                body = df.iloc[start : start + COPY_CHUNKSIZE].to_csv(
+                    index=False, header=False
+                )
+                key = f"{prefix}part_{part:05d}.csv.gz"
+                s3.put_object(
+                    Bucket=S3_BUCKET, Key=key, Body=gzip.compress(body.encode("utf-8"))
+                )
+                keys.append(key)
+
+        except Exception:
+            self.unstage_s3(s3, keys)
+            raise
+
+        return s3, prefix, keys
+
+    def s3_copy_sql(self, df, table, prefix):
+        """Redshift COPY of the parts staged under prefix"""
+
+        if REDSHIFT_IAM_ROLE is not None:
+            credentials = f"iam_role '{REDSHIFT_IAM_ROLE}'"
         else:
-            df.to_sql(
-                f"{self.table_prefix}_{endpoint}",
-                self.sql_engine,
-                schema=self.schema,
-                if_exists="append",
-                index=False,
-                dtype=mapper,
-                method="multi",
-                chunksize=10000,
+            credentials = (
+                f"access_key_id '{AWS_ACCESS_KEY_ID}' "
+                f"secret_access_key '{AWS_SECRET_ACCESS_KEY}'"
             )
+
+        return (
+            f"copy {self.copy_statement(df, table)} "
+            f"from 's3://{S3_BUCKET}/{prefix}' {credentials} "
+            "format as csv gzip timeformat 'auto' emptyasnull"
+        )
+
+    def unstage_s3(self, s3, keys):
+
+        for key in keys:
+            s3.delete_object(Bucket=S3_BUCKET, Key=key)
@@ -0,0 +1,286 @@
+"""Concurrency limiters that get_page acquires around each request"""
+
+import asyncio
+import collections
+import contextlib
+import fcntl
+import os
+import random
+import time
+
+import mobile_commons_logging as mclg
+
+# Slot files coordinating the host-wide connection budget between processes
+LOCK_DIR = os.getenv("MC_LIMITER_DIR", "/tmp/mobile_commons_limiter")
+
+logger = mclg.get_logger("limiter")
+
+
+class adaptive_limiter:
+    """
+    AIMD concurrency limit: starts at the ceiling, halves on 429/5xx or connection errors and
+    when latency rises, and grows back by one slot for every window of healthy responses.
+    Latency is the server's round trip, from taking a slot to the response headers. A request
+    the event loop stalled during (parsing, say) can't tell a busy loop from a slow server, so
+    its latency is left out. It's judged per endpoint, against the lowest latency among that
+    endpoint's last `baseline_window` such requests
+    """
+
+    def __init__(self, floor, ceiling, **kwargs):
+
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = kwargs.get("initial", ceiling)
+        self.backoff = kwargs.get("backoff", 0.5)
+        self.latency_tolerance = kwargs.get("latency_tolerance", 2.0)
+        self.smoothing = kwargs.get("smoothing", 0.1)
+        self.baseline_window = kwargs.get("baseline_window", 200)
+        # How often the event loop is checked for stalls
+        self.tick = kwargs.get("tick", 0.01)
+        self.in_flight = 0
+        self.healthy = 0
+        # Per endpoint: smoothed latency and the recent samples its baseline is the minimum of
+        self.latency = {}
+        self.samples = {}
+        self.last_backoff = 0.0
+        # Responses since the last back-off, the ones before it were sent at the old limit
+        self.since_backoff = 0
+        self.backoffs = 0
+        self.requests = 0
+        self.errors = 0
+        self.stalled = 0.0
+        self.next_tick = None
+        self.monitor = None
+        # Tasks waiting for a slot, first come first served
+        self.waiters = collections.deque()
+
+    def start(self):
+
+        if (self.monitor is None) or self.monitor.done():
+            self.monitor = asyncio.ensure_future(self.watch_loop())
+
+    async def watch_loop(self):
+        """Adds up how late the event loop wakes this task, which is time it spent stalled"""
+
+        while True:
+            self.next_tick = time.monotonic() + self.tick
+            await asyncio.sleep(self.tick)
+            self.stalled += max(0.0, time.monotonic() - self.next_tick)
+            self.next_tick = None
+
+    def stalls(self):
+        """Seconds the event loop has spent stalled so far, to tell how long it stalled during a request"""
+
+        self.start()
+        stalled = self.stalled
+
+        # A stall still going on (or not yet noticed by watch_loop) counts too
+        if self.next_tick is not None:
+            stalled += max(0.0, time.monotonic() - self.next_tick)
+
+        return stalled
+
+    def close(self):
+
+        if self.monitor is not None:
+            self.monitor.cancel()
+            self.monitor = None
+
+    async def __aenter__(self):
+
+        self.start()
+
+        if (self.in_flight < self.limit) and (len(self.waiters) == 0):
+            self.in_flight += 1
+            return self
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                # Unless wake() already skipped it
+                with contextlib.suppress(ValueError):
+                    self.waiters.remove(waiter)
+            else:
+                # Handed a slot just as it was cancelled, it goes to the next waiter instead
+                self.release()
+            raise
+
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        self.release()
+
+    def release(self):
+
+        self.in_flight -= 1
+        self.wake()
+
+    def wake(self):
+        """Hands the free slots to the longest waiting tasks, waking only as many as there are slots"""
+
+        while (len(self.waiters) > 0) and (self.in_flight < self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def observe(self, latency, status, key=None, stalled=0.0):
+        """
+        Feeds back the latency (to the response headers), HTTP status (None for connection
+        errors) and the seconds the event loop stalled meanwhile of a request to endpoint `key`.
+        Cancelled requests aren't reported
+        """
+
+        self.requests += 1
+        self.since_backoff += 1
+
+        if (status is None) or (status == 429) or (status >= 500):
+            self.errors += 1
+            # Only back off once per round trip so one burst of failures doesn't collapse the limit
+            if time.monotonic() - self.last_backoff >= self.latency.get(key, latency):
+                self.back_off()
+            return
+
+        if stalled > self.tick:
+            # Neither grows nor shrinks the limit, the latency is mostly the loop's
+            return
+
+        # Errors can come back much faster (or slower) than pages, only healthy responses set the baseline
+        smoothed = self.latency.get(key, latency)
+        smoothed += self.smoothing * (latency - smoothed)
+        self.latency[key] = smoothed
+
+        samples = self.samples.setdefault(key, collections.deque(maxlen=self.baseline_window))
+        samples.append(latency)
+
+        if smoothed > min(samples) * self.latency_tolerance:
+            # Once per window, the smoothed latency takes that long to show the lower limit
+            if self.since_backoff >= self.limit:
+                self.back_off()
+            return
+
+        self.healthy += 1
+        if self.healthy >= self.limit:
+            self.healthy = 0
+            self.set_limit(min(self.ceiling, self.limit + 1))
+
+    def back_off(self):
+
+        self.last_backoff = time.monotonic()
+        self.since_backoff = 0
+        self.healthy = 0
+
+        limit = max(self.floor, int(self.limit * self.backoff))
+        if limit != self.limit:
+            self.backoffs += 1
+            self.set_limit(limit)
+
+    def set_limit(self, limit):
+
+        if limit != self.limit:
+            # Backing off is news, the slow climb back up is detail
+            log = logger.info if limit < self.limit else logger.debug
+            log("Concurrency limit %s -> %s", self.limit, limit, extra={"limit": limit})
+            self.limit = limit
+            self.wake()
+
+    def stats(self):
+        """Current limit and counters (stalled is the seconds the event loop was blocked), for reporting"""
+
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "backoffs": self.backoffs,
+            "requests": self.requests,
+            "errors": self.errors,
+            "stalled": round(self.stalled, 3),
+            "latency": {key: round(latency, 4) for key, latency in self.latency.items()},
+        }
+
+
+class host_limiter:
+    """
+    Connection budget shared by every process on the machine. Each connection holds an
+    exclusive flock on one of `slots` files in lock_dir, so processes coordinate without a
+    broker and a crashed process releases its slots automatically
+    """
+
+    def __init__(self, slots, lock_dir=LOCK_DIR, poll=0.02):
+
+        self.slots = slots
+        self.lock_dir = lock_dir
+        self.poll = poll
+        self.fds = None
+        self.free = None
+        self.held = {}
+
+    def open(self):
+
+        if self.fds is None:
+            os.makedirs(self.lock_dir, exist_ok=True)
+            self.fds = [
+                os.open(
+                    os.path.join(self.lock_dir, f"slot_{slot:04d}.lock"),
+                    os.O_RDWR | os.O_CREAT,
+                    0o666,
+                )
+                for slot in range(self.slots)
+            ]
+            self.free = set(range(self.slots))
+
+    def try_acquire(self):
+        """Locks any slot not already held by another process, returning it or None"""
+
+        candidates = list(self.free)
+        random.shuffle(candidates)
+
+        for slot in candidates:
+            try:
+                fcntl.flock(self.fds[slot], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+
+            self.free.remove(slot)
+            return slot
+
+        return None
+
+    async def __aenter__(self):
+
+        self.open()
+        slot = self.try_acquire()
+
+        while slot is None:
+            await asyncio.sleep(self.poll * (1 + random.random()))
+            slot = self.try_acquire()
+
+        self.held[asyncio.current_task()] = slot
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+
+        slot = self.held.pop(asyncio.current_task())
+        fcntl.flock(self.fds[slot], fcntl.LOCK_UN)
+        self.free.add(slot)
+
+    def close(self):
+
+        if self.fds is not None:
+            for fd in self.fds:
+                os.close(fd)
+            self.fds = None
+
+
+class null_limiter:
+    """Stand-in when no host-wide budget is configured"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
@@ -0,0 +1,208 @@
+"""
+Loads a child endpoint's slices in batches as they arrive, instead of concatenating every
+campaign/group/tinyurl into one frame first, so memory stays flat however many there are
+"""
+
+import asyncio
+import functools
+import os
+import time
+import uuid
+
+import pandas as pd
+import sqlalchemy
+
+import mobile_commons_logging as mclg
+import mobile_commons_sink as mcsk
+
+# A batch is flushed once either threshold is reached
+LOAD_BATCH_ROWS = int(os.getenv("LOAD_BATCH_ROWS", 250000))
+LOAD_BATCH_MB = int(os.getenv("LOAD_BATCH_MB", 256))
+
+logger = mclg.get_logger("loader")
+
+
+class batch_loader:
+    """
+    Buffers slices and loads them batch by batch with `tap`, a connection for the endpoint.
+    Each batch is its own transaction on incremental runs and advances the watermarks of the
+    parents it holds. Full builds write every batch to a staging table and swap it in on close,
+    so the old table stays in place until the whole endpoint has loaded
+    """
+
+    def __init__(self, tap, endpoint, max_rows=LOAD_BATCH_ROWS, max_bytes=LOAD_BATCH_MB * 2 ** 20):
+
+        self.tap = tap
+        self.endpoint = endpoint
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.pending = []
+        self.pending_taps = []
+        self.loaded_taps = []
+        self.pending_rows = 0
+        self.pending_bytes = 0
+        self.columns = None
+        self.staging = None
+        self.parquet_staging = None
+        self.watermarks = {}
+        self.batches = []
+        self.lock = asyncio.Lock()
+
+    @property
+    def rows(self):
+
+        return sum(batch["rows"] for batch in self.batches)
+
+    async def add(self, df, subtap=None):
+        """
+        Buffers a slice, flushing once the batch is big enough. Waits while a batch loads, so
+        slices can't pile up behind it and pending stays within a batch plus one slice.
+        subtap's spool is cleared after its batch loads
+        """
+
+        async with self.lock:
+            self.pending.append(df)
+            self.pending_taps.append(subtap)
+            self.pending_rows += df.shape[0]
+            self.pending_bytes += df.memory_usage(deep=True).sum()
+
+            if (self.pending_rows >= self.max_rows) or (self.pending_bytes >= self.max_bytes):
+                await self.load_pending()
+
+    async def flush(self):
+
+        async with self.lock:
+            await self.load_pending()
+
+    async def load_pending(self):
+        """Loads the pending slices as one batch, with the lock held"""
+
+        if len(self.pending) == 0:
+            return
+
+        frames, taps = self.pending, self.pending_taps
+        self.pending, self.pending_taps = [], []
+        self.pending_rows, self.pending_bytes = 0, 0
+
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, functools.partial(self.load_batch, frames))
+
+        if self.tap.full_build:
+            # Their pages are needed again if the run dies before the swap
+            self.loaded_taps += taps
+        else:
+            self.clear_spools(taps)
+
+    def clear_spools(self, taps):
+
+        for subtap in taps:
+            if subtap is not None:
+                subtap.clear_spool()
+
+    def load_batch(self, frames):
+
+        with self.tap.profiler.region(self.endpoint, "load"):
+            started = time.monotonic()
+            df = pd.concat(frames, sort=True, join="inner")
+            del frames
+
+            # Later batches follow the first one's columns, so they always fit the table it created
+            if self.columns is None:
+                self.columns = list(df.columns)
+            else:
+                df = df.reindex(columns=self.columns)
+
+            df, mapper = self.tap.prepare(df)
+            table = self.tap.table_name(self.endpoint)
+
+            logger.info(
+                "Loading batch %s of endpoint %s (%s rows) into database...",
+                len(self.batches) + 1,
+                str.upper(self.endpoint),
+                df.shape[0],
+                extra={"endpoint": self.endpoint, "batch": len(self.batches) + 1, "rows": df.shape[0]},
+            )
+
+            if self.tap.full_build:
+                if_exists = "append"
+                if self.staging is None:
+                    self.staging = f"{table}_staging_{uuid.uuid4().hex[:8]}"
+                    if_exists = "replace"
+
+                self.tap.write_table(df, self.staging, if_exists, mapper)
+
+                # Recorded on close, the marks must not move before the new table is swapped in
+                for parent, latest in (self.tap.latest_watermarks(df) or {}).items():
+                    current = self.watermarks.get(parent)
+                    if pd.isnull(current) or ((not pd.isnull(latest)) and (latest > current)):
+                        self.watermarks[parent] = latest
+
+            elif self.tap.load_mode == "upsert":
+                self.tap.upsert(df, table, mapper)
+                self.tap.record_watermarks(df, self.endpoint)
+
+            else:
+                self.tap.write_table(df, table, "append", mapper)
+                self.tap.record_watermarks(df, self.endpoint)
+
+            if self.tap.full_build and (self.tap.parquet_dir is not None) and (self.parquet_staging is None):
+                self.parquet_staging = mcsk.parquet_sink(self.tap.parquet_dir).staging_dir()
+
+            # Like the watermarks, a full build's files are only published once its table is swapped in
+            self.tap.write_parquet(df, self.endpoint, staging=self.parquet_staging)
+
+            self.batches.append(
+                {
+                    "rows": df.shape[0],
+                    "bytes": int(df.memory_usage(deep=True).sum()),
+                    "seconds": time.monotonic() - started,
+                }
+            )
+
+    async def close(self):
+        """Flushes what's left and, for full builds, swaps the staging table in"""
+
+        await self.flush()
+
+        if self.staging is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, self.swap)
+
+        self.clear_spools(self.loaded_taps)
+        self.loaded_taps = []
+
+    def swap(self):
+
+        schema = self.tap.schema
+        table = self.tap.table_name(self.endpoint)
+
+        with self.tap.profiler.region(self.endpoint, "load"), self.tap.metrics.timer(
+            "load", self.endpoint
+        ), self.tap.sql_engine.begin() as conn:
+            conn.execute(sqlalchemy.text(f'drop table if exists {schema}."{table}"'))
+            conn.execute(
+                sqlalchemy.text(f'alter table {schema}."{self.staging}" rename to "{table}"')
+            )
+
+        self.staging = None
+
+        if self.tap.db_incremental_key is not None:
+            self.tap.watermarks.set(self.endpoint, self.watermarks, replace=True)
+
+        if self.parquet_staging is not None:
+            mcsk.parquet_sink(self.tap.parquet_dir).publish(self.parquet_staging)
+            self.parquet_staging = None
+
+    def abort(self):
+        """Drops a half-written staging table (and staged Parquet files) after a failed full build"""
+
+        if self.parquet_staging is not None:
+            mcsk.parquet_sink(self.tap.parquet_dir).discard(self.parquet_staging)
+            self.parquet_staging = None
+
+        if self.staging is not None:
+            with self.tap.sql_engine.begin() as conn:
+                conn.execute(
+                    sqlalchemy.text(f'drop table if exists {self.tap.schema}."{self.staging}"')
+                )
+            self.staging = None
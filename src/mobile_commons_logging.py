@@ -0,0 +1,145 @@
+"""
+Leveled, structured logging for the extraction. Every module logs under the "mobile_commons"
+logger, per-page detail at DEBUG and rate-limited progress at INFO, so a 20,000-page run writes
+a few lines a minute instead of one per request. Fields passed with `extra` (endpoint, parent,
+page, ...) are appended as key=value pairs, or become keys of the object with LOG_FORMAT=json
+"""
+
+import datetime
+import json
+import logging
+import os
+import sys
+import time
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "text" or "json" (one object per line)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# A progress line is logged every this many pages (or slices), or this many seconds, whichever comes first
+LOG_PROGRESS_EVERY = int(os.getenv("LOG_PROGRESS_EVERY", 500))
+LOG_PROGRESS_SECONDS = float(os.getenv("LOG_PROGRESS_SECONDS", 30))
+
+ROOT = "mobile_commons"
+
+# Attributes every LogRecord has, anything else on a record came in through `extra`
+RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def get_logger(name):
+
+    return logging.getLogger("{}.{}".format(ROOT, name))
+
+
+def fields(record):
+    """The structured fields a record was logged with"""
+
+    return {k: v for k, v in vars(record).items() if k not in RESERVED}
+
+
+class text_formatter(logging.Formatter):
+    def __init__(self):
+
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+
+        line = super().format(record)
+        extra = fields(record)
+
+        if len(extra) > 0:
+            line += " " + " ".join("{}={}".format(k, v) for k, v in extra.items())
+
+        return line
+
+
+class json_formatter(logging.Formatter):
+    def format(self, record):
+
+        entry = {
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(fields(record))
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def configure(level=None, fmt=None, stream=None):
+    """Sends the extraction's logs to stdout (where Airflow and Civis pick them up), once per process"""
+
+    logger = logging.getLogger(ROOT)
+
+    if any(getattr(h, "mobile_commons", False) for h in logger.handlers):
+        return logger
+
+    handler = logging.StreamHandler(stream or sys.stdout)
+    handler.mobile_commons = True
+    handler.setFormatter(json_formatter() if (fmt or LOG_FORMAT) == "json" else text_formatter())
+
+    logger.addHandler(handler)
+    logger.setLevel(str.upper(level or LOG_LEVEL))
+    logger.propagate = False
+
+    return logger
+
+
+class progress:
+    """Counts pages (or slices) and logs how far along they are, at most every `every` of them or `seconds`"""
+
+    def __init__(self, logger, label, unit="pages", **kwargs):
+
+        self.logger = logger
+        self.label = label
+        self.unit = unit
+        self.total = kwargs.get("total", None)
+        self.every = kwargs.get("every", LOG_PROGRESS_EVERY)
+        self.seconds = kwargs.get("seconds", LOG_PROGRESS_SECONDS)
+        self.fields = kwargs.get("fields", {})
+        self.count = 0
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+        self.started = time.monotonic()
+        self.logged_count = 0
+        self.logged_at = self.started
+
+    def update(self, count=1, rows=0, bytes=0, retries=0):
+
+        self.count += count
+        self.rows += rows
+        self.bytes += bytes
+        self.retries += retries
+
+        if (self.count - self.logged_count >= self.every) or (
+            time.monotonic() - self.logged_at >= self.seconds
+        ):
+            self.log()
+
+    def log(self):
+
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+
+        now = time.monotonic()
+        elapsed = max(now - self.started, 1e-9)
+        done = str(self.count) if self.total is None else "{}/{}".format(self.count, self.total)
+
+        extra = dict(self.fields, done=self.count, retries=self.retries, seconds=round(elapsed, 1))
+        # Only what's being counted, pages have bytes and slices have rows
+        for k in ("total", "rows", "bytes"):
+            if getattr(self, k):
+                extra[k] = getattr(self, k)
+
+        self.logger.info(
+            "%s: %s %s, %.1f %s/s", self.label, done, self.unit, self.count / elapsed, self.unit, extra=extra
+        )
+
+        self.logged_count = self.count
+        self.logged_at = now
@@ -0,0 +1,299 @@
+"""
+Run metrics for finding where extraction time goes: per-stage durations, rows and bytes,
+request latency histograms, status codes and retries, tagged by endpoint and parent id.
+Exported as a Prometheus textfile (for node_exporter's textfile collector) and as a JSON
+summary. Stages recorded by mobile_commons_connection are
+
+    http        a request, from sending it to reading the body (bytes are response sizes)
+    spool       reading a page back from the page spool instead of the API
+    parse       an XML page into column arrays (with parse workers, includes waiting for one)
+    collate     concatenating parsed pages and keeping the mapped columns
+    cast        casting to the declared dtypes
+    load        writing rows to a warehouse table (to_sql, COPY or S3 COPY) or swapping one in
+    merge       the delete + insert of an upsert
+    parquet     landing a batch in the Parquet dataset
+    watermarks  reading and advancing watermarks, including bootstrap scans
+
+and by the runner, as wall time that overlaps the stages above
+
+    extract     fetching a whole result set
+    total       a whole job
+"""
+
+import contextlib
+import datetime
+import os
+import threading
+import time
+
+import mobile_commons_state as mcst
+
+# Where the runner writes the Prometheus textfile at the end of a run (off when unset)
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE")
+
+# Upper bounds of the request latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+# Parents listed per endpoint in the JSON summary, slowest first, to keep it small enough for XCom
+TOP_PARENTS = 10
+
+PREFIX = "mobile_commons"
+
+
+def label_value(value):
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(**kwargs):
+
+    return "{" + ",".join('{}="{}"'.format(k, label_value(v)) for k, v in kwargs.items()) + "}"
+
+
+class run_metrics:
+    """Thread-safe counters for one run, shared by every connection, loader and the runner"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (endpoint, parent, stage) -> calls, seconds, rows and bytes
+        self.stages = {}
+        # (endpoint, parent) -> latency histogram, status counts and retries
+        self.requests = {}
+        # name -> value and description, e.g. the limiter's state at the end of the run
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def timer(self, stage, endpoint, parent=None):
+        """Times a block as one call of a stage. Set "rows"/"bytes" on the yielded dict to count them too"""
+
+        measured = {"rows": 0, "bytes": 0}
+        started = time.monotonic()
+
+        try:
+            yield measured
+        finally:
+            self.add(stage, endpoint, parent, time.monotonic() - started, **measured)
+
+    def add(self, stage, endpoint, parent=None, seconds=0.0, rows=0, bytes=0):
+
+        key = (endpoint, mcst.parent_key(parent), stage)
+
+        with self.lock:
+            totals = self.stages.setdefault(key, {"calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["rows"] += int(rows)
+            totals["bytes"] += int(bytes)
+
+    def request_totals(self, endpoint, parent):
+
+        return self.requests.setdefault(
+            (endpoint, mcst.parent_key(parent)),
+            {
+                "buckets": [0] * (len(self.buckets) + 1),
+                "count": 0,
+                "seconds": 0.0,
+                "statuses": {},
+                "retries": 0,
+            },
+        )
+
+    def request(self, endpoint, parent, latency, status, bytes=0):
+        """
+        Records a request's latency and HTTP status (None for connection errors, "cancelled" for
+        cancelled requests) as part of the http stage
+        """
+
+        self.add("http", endpoint, parent, latency, bytes=bytes)
+
+        bucket = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if latency <= bound:
+                bucket = i
+                break
+
+        status = "error" if status is None else str(status)
+
+        with self.lock:
+            totals = self.request_totals(endpoint, parent)
+            totals["buckets"][bucket] += 1
+            totals["count"] += 1
+            totals["seconds"] += latency
+            totals["statuses"][status] = totals["statuses"].get(status, 0) + 1
+
+    def gauge(self, name, value, description):
+
+        with self.lock:
+            self.gauges[name] = (value, description)
+
+    def retry(self, endpoint, parent=None):
+
+        with self.lock:
+            self.request_totals(endpoint, parent)["retries"] += 1
+
+    def stage_totals(self, endpoint=None):
+        """Stage totals summed over parents (and endpoints unless one is given)"""
+
+        totals = {}
+
+        with self.lock:
+            for (e, parent, stage), values in self.stages.items():
+                if (endpoint is not None) and (e != endpoint):
+                    continue
+                merged = totals.setdefault(stage, {"calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0})
+                for k, v in values.items():
+                    merged[k] += v
+
+        return totals
+
+    def summary(self):
+        """JSON-ready summary per endpoint, with the slowest parents broken out"""
+
+        endpoints = {}
+
+        with self.lock:
+            stages = dict(self.stages)
+            requests = dict(self.requests)
+
+        for (endpoint, parent, stage), values in stages.items():
+            summary = endpoints.setdefault(endpoint, {"stages": {}, "requests": None, "parents": {}})
+            merged = summary["stages"].setdefault(stage, {"calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0})
+            for k, v in values.items():
+                merged[k] += v
+
+            if parent != mcst.NO_PARENT:
+                summary["parents"].setdefault(parent, {})[stage] = round(values["seconds"], 3)
+
+        for (endpoint, parent), values in requests.items():
+            summary = endpoints.setdefault(endpoint, {"stages": {}, "requests": None, "parents": {}})
+            merged = summary["requests"] or {
+                "count": 0,
+                "seconds": 0.0,
+                "retries": 0,
+                "statuses": {},
+                "buckets": [0] * (len(self.buckets) + 1),
+            }
+            merged["count"] += values["count"]
+            merged["seconds"] += values["seconds"]
+            merged["retries"] += values["retries"]
+            for status, n in values["statuses"].items():
+                merged["statuses"][status] = merged["statuses"].get(status, 0) + n
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], values["buckets"])]
+            summary["requests"] = merged
+
+        for summary in endpoints.values():
+            for values in summary["stages"].values():
+                values["seconds"] = round(values["seconds"], 3)
+
+            requests = summary["requests"]
+            if requests is not None:
+                requests["mean_latency"] = round(requests["seconds"] / max(requests["count"], 1), 4)
+                requests["seconds"] = round(requests["seconds"], 3)
+                bounds = [str(b) for b in self.buckets] + ["+Inf"]
+                requests["buckets"] = dict(zip(bounds, requests.pop("buckets")))
+
+            slowest = sorted(summary["parents"].items(), key=lambda item: -sum(item[1].values()))
+            summary["parents"] = dict(slowest[:TOP_PARENTS])
+
+        return {
+            "started_at": datetime.datetime.fromtimestamp(self.started, datetime.timezone.utc).isoformat(
+                timespec="seconds"
+            ),
+            "seconds": round(time.time() - self.started, 3),
+            "endpoints": endpoints,
+        }
+
+    def textfile(self):
+        """Metrics in the Prometheus text format. Histograms are per endpoint, counters per endpoint and parent"""
+
+        with self.lock:
+            stages = dict(self.stages)
+            requests = dict(self.requests)
+            gauges = dict(self.gauges)
+
+        lines = []
+
+        for field, unit, description in [
+            ("seconds", "seconds", "Seconds spent in each stage"),
+            ("calls", "calls", "Calls of each stage"),
+            ("rows", "rows", "Rows through each stage"),
+            ("bytes", "bytes", "Bytes through each stage"),
+        ]:
+            name = "{}_stage_{}_total".format(PREFIX, unit)
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} counter".format(name))
+            for (endpoint, parent, stage), values in sorted(stages.items()):
+                lines.append(
+                    "{}{} {}".format(name, labels(endpoint=endpoint, parent=parent, stage=stage), values[field])
+                )
+
+        histograms = {}
+        for (endpoint, parent), values in requests.items():
+            merged = histograms.setdefault(
+                endpoint,
+                {"buckets": [0] * (len(self.buckets) + 1), "count": 0, "seconds": 0.0, "statuses": {}},
+            )
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], values["buckets"])]
+            merged["count"] += values["count"]
+            merged["seconds"] += values["seconds"]
+            for status, n in values["statuses"].items():
+                merged["statuses"][status] = merged["statuses"].get(status, 0) + n
+
+        name = PREFIX + "_request_duration_seconds"
+        lines.append("# HELP {} Latency of Mobile Commons API requests".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for endpoint, merged in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip([str(b) for b in self.buckets] + ["+Inf"], merged["buckets"]):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(name, labels(endpoint=endpoint, le=bound), cumulative))
+            lines.append("{}_sum{} {}".format(name, labels(endpoint=endpoint), merged["seconds"]))
+            lines.append("{}_count{} {}".format(name, labels(endpoint=endpoint), merged["count"]))
+
+        name = PREFIX + "_requests_total"
+        lines.append("# HELP {} Mobile Commons API requests by HTTP status".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        for endpoint, merged in sorted(histograms.items()):
+            for status, n in sorted(merged["statuses"].items()):
+                lines.append("{}{} {}".format(name, labels(endpoint=endpoint, status=status), n))
+
+        name = PREFIX + "_retries_total"
+        lines.append("# HELP {} Retried Mobile Commons API requests".format(name))
+        lines.append("# TYPE {} counter".format(name))
+        for (endpoint, parent), values in sorted(requests.items()):
+            lines.append("{}{} {}".format(name, labels(endpoint=endpoint, parent=parent), values["retries"]))
+
+        for gauge, (value, description) in sorted(gauges.items()):
+            name = "{}_{}".format(PREFIX, gauge)
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} gauge".format(name))
+            lines.append("{} {}".format(name, value))
+
+        name = PREFIX + "_run_seconds"
+        lines.append("# HELP {} Duration of the run".format(name))
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("{} {}".format(name, round(time.time() - self.started, 3)))
+
+        name = PREFIX + "_last_run_timestamp_seconds"
+        lines.append("# HELP {} When the run finished".format(name))
+        lines.append("# TYPE {} gauge".format(name))
+        lines.append("{} {}".format(name, int(time.time())))
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        """Writes the textfile atomically, so the collector never reads a half-written one"""
+
+        partial = path + ".partial"
+
+        with open(partial, "w") as f:
+            f.write(self.textfile())
+
+        os.replace(partial, path)
+
+
+# Used by connections that aren't handed one, e.g. when a script drives a connection directly
+METRICS = run_metrics()
@@ -0,0 +1,408 @@
+"""
+Local stand-in for the Mobile Commons API, so extraction can be benchmarked (see
+`python benchmark.py e2e`) or tried out without touching production. E.g.
+
+    python mobile_commons_mock.py --port 8770 --latency 0.05 --error-rate 0.01
+
+then run the jobs against it with MC_BASE_URL=http://localhost:8770/api/
+
+Every endpoint in mobile_commons_registry is served with deterministic records built from the
+columns in mobile_commons_data, paginated with `page`/`limit`, filtered by the endpoint's
+`start_time`/`from` key and with a page_count where the real API reports one. Requests beyond
+--max-concurrency in flight get a 429, --error-rate of them a 500, and /stats reports what was served
+"""
+
+import argparse
+import asyncio
+import bisect
+import datetime
+import random
+import time
+
+from xml.sax.saxutils import escape, quoteattr
+
+from aiohttp import web
+
+import mobile_commons_data as mcd
+import mobile_commons_registry as mcr
+
+COLUMNS = mcd.columns()
+
+# Records of every result set are spread evenly over this period, oldest first
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+SPAN_SECONDS = 365 * 24 * 3600
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S UTC"
+
+# Only these endpoints report a page_count, the rest have to be paged until they run dry
+PAGE_COUNT_ENDPOINTS = {"broadcasts", "messages", "sent_messages"}
+
+# Records per top-level endpoint, and the largest typical slice of a child endpoint per parent
+SIZES = {
+    "broadcasts": 2000,
+    "campaigns": 40,
+    "groups": 20,
+    "tags": 100,
+    "tinyurls": 20,
+    "profiles": 50000,
+    "messages": 4000,
+    "sent_messages": 8000,
+    "campaign_subscribers": 2000,
+    "group_members": 1000,
+    "clicks": 500,
+}
+
+ATTRIBUTES = {"id", "type", "status", "active", "approved"}
+
+# Distinct records rendered per endpoint. Record i reuses variant i % VARIANTS with its own id,
+# timestamp and parent filled in, so serving a page costs little more than joining strings
+VARIANTS = 1000
+
+VOCABULARY = {
+    "status": ["Active Subscriber", "Undeliverable", "Hard bounce", "No Subscriptions"],
+    "type": ["reply", "opt_in", "keyword", "generic"],
+    "carrier_name": ["Verizon Wireless", "AT&T", "T-Mobile", "US Cellular"],
+    "keyword": ["JOIN", "STOP", "INFO", "VOTE"],
+    "opted_out_source": ["texted_stop", "web", "admin", "carrier"],
+    "source": ["Web Form", "Keyword", "API", "Import"],
+    "taggable_object": ["Profile", "Campaign", "Broadcast"],
+    "mode": ["redirect", "track"],
+    "host": ["mcom.link", "m.example.org"],
+}
+
+# Where an endpoint's values differ from the generic vocabulary
+ENDPOINT_VOCABULARY = {
+    ("groups", "type"): ["UploadedGroup", "FilteredGroup", "BroadcastGroup"],
+    ("groups", "status"): ["active", "archived"],
+    ("broadcasts", "status"): ["sent", "scheduled", "draft"],
+    ("sent_messages", "status"): ["delivered", "sent", "undeliverable"],
+    ("sent_messages", "type"): ["broadcast", "generic", "reply"],
+}
+
+
+def endpoints():
+    """What the mock needs to know about each API endpoint, from the registry's jobs"""
+
+    specs = {}
+
+    for job, spec in mcr.ENDPOINTS.items():
+        endpoint = spec["endpoint"]
+        parent = spec.get("parent")
+        columns = COLUMNS.columns[endpoint]
+        times = [c for c, dtype in columns.items() if dtype.startswith("datetime64")]
+
+        specs[endpoint] = {
+            "container": spec["container"],
+            "record": spec["record"],
+            "filter": spec["api_incremental_key"],
+            "time_column": spec["db_incremental_key"] or (times[0] if times else None),
+            "parent": None if parent is None else mcr.ENDPOINTS[parent]["endpoint"],
+            "index": spec.get("index"),
+            "columns": columns,
+        }
+
+    return specs
+
+
+def timestamp(seconds):
+
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+
+
+def parse_since(value):
+    """Seconds since EPOCH of a start_time/from value, as the runner formats it"""
+
+    value = value.strip().replace(" UTC", "+00:00").replace("Z", "+00:00")
+    since = datetime.datetime.fromisoformat(value)
+
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=datetime.timezone.utc)
+
+    return (since - EPOCH).total_seconds()
+
+
+def value(endpoint, column, dtype, rng, variant):
+    """A plausible raw value for a column that doesn't depend on the record's position"""
+
+    if dtype.startswith("datetime64"):
+        if column.startswith("opted_out") and rng.random() > 0.1:
+            return None
+        return timestamp(rng.randrange(SPAN_SECONDS))
+
+    if dtype == "Int64":
+        return str(rng.randrange(1, 100000))
+    if dtype == "boolean":
+        return rng.choice(("true", "false"))
+    if dtype == "category":
+        vocabulary = ENDPOINT_VOCABULARY.get((endpoint, column), VOCABULARY.get(column))
+        return rng.choice(vocabulary or ["{} {}".format(column, rng.randrange(5))])
+
+    if column == "phone_number":
+        return "+1555{:07d}".format(rng.randrange(10000000))
+    if column == "email":
+        return "person{}@example.org".format(variant)
+    if column in ("first_name", "last_name", "name"):
+        return "{} {}".format(column.replace("_", " ").title(), variant)
+    if column == "body":
+        return "Message {} with a body of some realistic length for an SMS, reply STOP to quit".format(variant)
+    if column in ("url", "clicked_url", "http_referer"):
+        return "https://www.example.org/page/{}?utm_source=sms".format(rng.randrange(1000))
+    if column == "remote_addr":
+        return "10.{}.{}.{}".format(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    if column == "user_agent":
+        return "Mozilla/5.0 (iPhone; CPU iPhone OS 13_5 like Mac OS X) AppleWebKit/605.1.15"
+    if column == "key":
+        return "{:x}".format(rng.randrange(16 ** 6))
+
+    return "{} {}".format(column.replace("_", " "), rng.randrange(1000))
+
+
+def templates(endpoint, spec, seed):
+    """
+    Format strings for an endpoint's record variants, with ids, types and statuses as attributes
+    like the real API. Only the fields that depend on the record's position are left to fill in
+    """
+
+    # Filled in per record, everything else is rendered once
+    positional = {
+        "id": "{id}",
+        "next_id": "{next_id}",
+        "previous_id": "{previous_id}",
+        spec["time_column"]: "{time}",
+        spec["index"]: "{parent}",
+    }
+
+    variants = []
+
+    for variant in range(VARIANTS):
+        rng = random.Random("{}:{}:{}".format(seed, endpoint, variant))
+        attributes = []
+        children = []
+
+        for column, dtype in spec["columns"].items():
+            if column in positional:
+                text = positional[column]
+            elif column == "campaign":
+                # Messages nest their campaign, as the real API does
+                children.append(
+                    '<campaign id="{{parent}}" active="true">Campaign {}</campaign>'.format(variant)
+                )
+                continue
+            else:
+                text = value(endpoint, column, dtype, rng, variant)
+                if text is None:
+                    continue
+                text = text.replace("{", "{{").replace("}", "}}")
+
+            if column in ATTRIBUTES:
+                attributes.append(" {}={}".format(column, quoteattr(text)))
+            else:
+                children.append("<{0}>{1}</{0}>".format(column, escape(text)))
+
+        variants.append(
+            "<{0}{1}>{2}</{0}>".format(spec["record"], "".join(attributes), "".join(children))
+        )
+
+    return variants
+
+
+class result_set:
+    """The records of one endpoint (for one parent), generated on demand from their position"""
+
+    def __init__(self, endpoint, spec, parent, size, variants):
+
+        self.endpoint = endpoint
+        self.spec = spec
+        self.parent = parent
+        self.size = size
+        self.variants = variants
+
+    def seconds(self, i):
+
+        return SPAN_SECONDS * i // self.size
+
+    def first_since(self, since):
+        """Position of the first record at or after `since` seconds"""
+
+        return bisect.bisect_left(range(self.size), since, key=self.seconds)
+
+    def record(self, i):
+
+        record_id = i + 1 if self.parent is None else int(self.parent) * 1000000 + i + 1
+
+        return self.variants[i % len(self.variants)].format(
+            id=record_id,
+            next_id=record_id + 1,
+            previous_id=record_id - 1,
+            time=timestamp(self.seconds(i)),
+            parent=self.parent or 1,
+        )
+
+    def page(self, page, limit, since=None):
+        """The <response> for a page, with the number of records it holds"""
+
+        first = 0 if since is None else self.first_since(since)
+        start = first + (page - 1) * limit
+        stop = min(start + limit, self.size)
+        records = [self.record(i) for i in range(start, stop)]
+
+        attributes = ' page="{}" limit="{}"'.format(page, limit)
+        if self.endpoint in PAGE_COUNT_ENDPOINTS:
+            attributes += ' page_count="{}"'.format(-(-(self.size - first) // limit))
+
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<response success="true"><{0}{1}>{2}</{0}></response>'
+        ).format(self.spec["container"], attributes, "".join(records))
+
+        return body, len(records)
+
+
+class mock_api:
+    """aiohttp application serving the registry's endpoints under /api/, with /stats"""
+
+    def __init__(self, **kwargs):
+
+        self.latency = kwargs.get("latency", 0.0)
+        self.jitter = kwargs.get("jitter", 0.0)
+        self.error_rate = kwargs.get("error_rate", 0.0)
+        self.malformed_rate = kwargs.get("malformed_rate", 0.0)
+        self.max_concurrency = kwargs.get("max_concurrency", 160)
+        self.scale = kwargs.get("scale", 1.0)
+        self.seed = kwargs.get("seed", 0)
+        self.specs = endpoints()
+        self.variants = {}
+        self.random = random.Random(self.seed)
+        self.in_flight = 0
+        self.stats = {
+            "requests": 0,
+            "pages": 0,
+            "rows": 0,
+            "bytes": 0,
+            "throttled": 0,
+            "errors": 0,
+            "malformed": 0,
+            "peak_in_flight": 0,
+            "render_seconds": 0.0,
+        }
+
+    def size(self, endpoint, parent):
+        """Records in a result set. Child slices are long-tailed, with a fifth of parents having none"""
+
+        size = SIZES.get(endpoint, 100) * self.scale
+
+        if parent is None:
+            return int(size)
+
+        spec = self.specs[endpoint]
+        parents = int(SIZES.get(spec["parent"], 100) * self.scale)
+
+        if not parent.isdigit() or not (1 <= int(parent) <= parents):
+            return 0
+
+        u = random.Random("{}:{}:{}".format(self.seed, endpoint, parent)).random()
+        return 0 if u < 0.2 else int(2 * size * u ** 3)
+
+    def result_set(self, endpoint, parent):
+
+        if endpoint not in self.variants:
+            self.variants[endpoint] = templates(endpoint, self.specs[endpoint], self.seed)
+
+        return result_set(
+            endpoint, self.specs[endpoint], parent, self.size(endpoint, parent), self.variants[endpoint]
+        )
+
+    async def handle(self, request):
+
+        endpoint = request.match_info["endpoint"]
+        if endpoint not in self.specs:
+            raise web.HTTPNotFound()
+
+        self.stats["requests"] += 1
+        self.in_flight += 1
+        self.stats["peak_in_flight"] = max(self.stats["peak_in_flight"], self.in_flight)
+
+        try:
+            if self.in_flight > self.max_concurrency:
+                self.stats["throttled"] += 1
+                return web.Response(status=429, text="Too Many Requests")
+
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+            if self.random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return web.Response(status=500, text="Internal Server Error")
+
+            return self.respond(endpoint, request.query)
+
+        finally:
+            self.in_flight -= 1
+
+    def respond(self, endpoint, query):
+
+        spec = self.specs[endpoint]
+        parent = query.get(spec["index"]) if spec["index"] is not None else None
+        since = query.get(spec["filter"]) if spec["filter"] is not None else None
+
+        started = time.monotonic()
+        body, rows = self.result_set(endpoint, parent).page(
+            page=int(query.get("page", 1)),
+            limit=int(query.get("limit", 20)),
+            since=None if not since else parse_since(since),
+        )
+        self.stats["render_seconds"] += time.monotonic() - started
+
+        if self.random.random() < self.malformed_rate:
+            self.stats["malformed"] += 1
+            body = body[: len(body) // 2]
+        else:
+            self.stats["pages"] += 1
+            self.stats["rows"] += rows
+
+        self.stats["bytes"] += len(body)
+
+        return web.Response(text=body, content_type="text/xml")
+
+    async def report(self, request):
+
+        return web.json_response(self.stats)
+
+    def application(self):
+
+        app = web.Application()
+        app.router.add_get("/stats", self.report)
+        app.router.add_get("/api/{endpoint}", self.handle)
+        return app
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Mobile Commons API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8770)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 500")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="share of pages cut off mid-XML")
+    parser.add_argument(
+        "--max-concurrency", type=int, default=160, help="requests in flight before answering 429"
+    )
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplies the number of records served")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    api = mock_api(
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        max_concurrency=args.max_concurrency,
+        scale=args.scale,
+        seed=args.seed,
+    )
+
+    web.run_app(api.application(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+
+    main()
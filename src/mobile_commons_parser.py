@@ -0,0 +1,132 @@
+"""Streaming XML parser that turns a Mobile Commons <response> page straight into column arrays"""
+
+import io
+import re
+
+from lxml import etree
+
+# Enough of a body to hold the <response> tag and, on failures, its <error>
+HEAD_BYTES = 4096
+ROOT = re.compile(rb"<response\b([^>]*)>")
+FAILED = re.compile(rb"""\bsuccess\s*=\s*["']false["']""")
+
+
+class response_error(Exception):
+    """A page the API answered with success="false" instead of records, or one cut off before its end"""
+
+
+def check_response(data):
+    """
+    Raises response_error for an error response or a body cut off before </response>, reading
+    no further than its first and last few bytes, so a bad page is never spooled or parsed
+    """
+
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    head = data[:HEAD_BYTES]
+    root = ROOT.search(head)
+
+    if (root is not None) and (FAILED.search(root.group(1)) is not None):
+        raise response_error(head.decode("utf-8", "replace"))
+
+    if (root is None) or not (root.group(0).endswith(b"/>") or data.rstrip().endswith(b"</response>")):
+        raise response_error("Incomplete response of {} bytes".format(len(data)))
+
+
+def element_value(element):
+    """Mirrors the value xmltodict gives an element: plain text for leaves, a dict otherwise"""
+
+    text = element.text.strip() if element.text is not None else ""
+
+    if len(element) == 0 and len(element.attrib) == 0:
+        return text or None
+
+    value = {"@" + k: v for k, v in element.attrib.items()}
+
+    for child in element:
+        child_value = element_value(child)
+        if child.tag in value:
+            if not isinstance(value[child.tag], list):
+                value[child.tag] = [value[child.tag]]
+            value[child.tag].append(child_value)
+        else:
+            value[child.tag] = child_value
+
+    if text:
+        value["#text"] = text
+
+    return value
+
+
+class record_parser:
+    def __init__(self, record_tag, container_tag, columns):
+
+        self.record_tag = record_tag
+        self.container_tag = container_tag
+        self.columns = set(columns)
+
+    def parse(self, data):
+        """
+        Walks a response with iterparse, emitting only the mapped columns of each record
+        element directly under the container. Returns the column arrays, the number of
+        records seen and the container metadata (e.g. page_count). Raises response_error
+        for an error response, which would otherwise look like an empty page
+        """
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        cols = {}
+        meta = {}
+        rows = 0
+        depth = 0
+
+        for event, element in etree.iterparse(
+            io.BytesIO(data), events=("start", "end"), huge_tree=True
+        ):
+
+            if event == "start":
+                depth += 1
+                if depth == 1 and element.get("success") == "false":
+                    raise response_error(etree.tostring(element)[:HEAD_BYTES].decode("utf-8", "replace"))
+                if depth == 2 and element.tag == self.container_tag:
+                    meta.update(element.attrib)
+                continue
+
+            depth -= 1
+
+            if depth != 2:
+                continue
+
+            parent = element.getparent()
+
+            if parent.tag == self.container_tag and parent.getparent().tag == "response":
+
+                if element.tag == self.record_tag:
+                    row = {
+                        k: v for k, v in element.attrib.items() if k in self.columns
+                    }
+                    for child in element:
+                        if child.tag in self.columns:
+                            row[child.tag] = element_value(child)
+
+                    for k, v in row.items():
+                        if k not in cols:
+                            cols[k] = [None] * rows
+                        cols[k].append(v)
+
+                    rows += 1
+
+                    for values in cols.values():
+                        if len(values) < rows:
+                            values.append(None)
+
+                elif element.tag == "page_count":
+                    meta["page_count"] = element_value(element)
+
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
+
+        return cols, rows, meta
@@ -0,0 +1,180 @@
+"""
+Opt-in profiling of the extraction and load hot paths. With PROFILE_DIR set (or --profile-dir
+on the runner), every endpoint's extraction (fetching, parsing and collating its pages) and load
+run under cProfile plus a stdlib sampling profiler, and a run directory
+
+    {profile_dir}/{run}/{endpoint}.{stage}.pstats     cProfile stats, e.g. `python -m pstats` or snakeviz
+    {profile_dir}/{run}/{endpoint}.{stage}.txt        the top functions by cumulative time
+    {profile_dir}/{run}/{endpoint}.{stage}.collapsed  sampled stacks for flamegraph.pl or speedscope
+
+is written at the end of the run. cProfile only sees the thread it's enabled on, so the runner
+runs jobs one at a time and parses pages inline while profiling, keeping each endpoint's work
+on its own and in view
+"""
+
+import collections
+import contextlib
+import cProfile
+import datetime
+import io
+import os
+import pstats
+import sys
+import threading
+
+import mobile_commons_logging as mclg
+
+# Profiling is off unless a directory is configured
+PROFILE_DIR = os.getenv("PROFILE_DIR")
+# Seconds between stack samples
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))
+
+logger = mclg.get_logger("profiling")
+
+
+def frame_name(frame):
+
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), getattr(code, "co_qualname", code.co_name))
+
+
+class sampler(threading.Thread):
+    """Samples the stacks of the threads inside a profiled region, counting them per region"""
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+
+        super().__init__(name="mobile_commons_sampler", daemon=True)
+        self.interval = interval
+        self.active = {}
+        self.counts = collections.defaultdict(collections.Counter)
+        self.stopped = threading.Event()
+
+    def run(self):
+
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+
+            for ident, key in list(self.active.items()):
+                frame = frames.get(ident)
+                stack = []
+
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+
+                if len(stack) > 0:
+                    self.counts[key][";".join(reversed(stack))] += 1
+
+    def stop(self):
+
+        self.stopped.set()
+        self.join()
+
+
+class profiler:
+    """
+    Profiles regions of work keyed by endpoint and stage. Re-entering a region (e.g. from the
+    concurrent slices of a child job) keeps its profile running, and a region entered on a
+    thread already inside another one is left to the outer region
+    """
+
+    def __init__(self, profile_dir=None, interval=PROFILE_INTERVAL):
+
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.run_dir = None
+        self.profiles = {}
+        self.depth = collections.Counter()
+        self.threads = {}
+        self.tracing = {}
+        self.sampler = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+
+        return self.profile_dir is not None
+
+    def region(self, endpoint, stage):
+        """Context manager profiling the block as part of an endpoint's stage, a no-op when disabled"""
+
+        if not self.enabled:
+            return contextlib.nullcontext()
+
+        return self.profiled((endpoint, stage))
+
+    def enable(self, key):
+
+        profile = self.profiles.setdefault(key, cProfile.Profile())
+
+        try:
+            profile.enable()
+        except ValueError:
+            # From Python 3.12 cProfile traces every thread and only one can run at a time, the
+            # region is left to the sampler while another one holds it
+            logger.debug("Not tracing %s %s, another profile is running", *key)
+            return False
+
+        return True
+
+    @contextlib.contextmanager
+    def profiled(self, key):
+
+        ident = threading.get_ident()
+
+        with self.lock:
+            if self.threads.get(ident, key) != key:
+                owner = None
+            else:
+                owner = key
+                if self.sampler is None:
+                    self.sampler = sampler(self.interval)
+                    self.sampler.start()
+                if self.depth[key] == 0:
+                    self.threads[ident] = key
+                    self.sampler.active[ident] = key
+                    self.tracing[key] = self.enable(key)
+                self.depth[key] += 1
+
+        try:
+            yield
+        finally:
+            if owner is not None:
+                with self.lock:
+                    self.depth[key] -= 1
+                    if self.depth[key] == 0:
+                        if self.tracing.pop(key):
+                            self.profiles[key].disable()
+                        self.sampler.active.pop(ident, None)
+                        self.threads.pop(ident, None)
+
+    def close(self):
+        """Stops sampling and writes every region's artifacts, returning the run directory"""
+
+        if self.sampler is not None:
+            self.sampler.stop()
+
+        if len(self.profiles) == 0:
+            return None
+
+        run = "{}-{}".format(datetime.datetime.now().strftime("%Y%m%dT%H%M%S"), os.getpid())
+        self.run_dir = os.path.join(self.profile_dir, run)
+        os.makedirs(self.run_dir, exist_ok=True)
+
+        for (endpoint, stage), profile in self.profiles.items():
+            path = os.path.join(self.run_dir, "{}.{}".format(endpoint, stage))
+            profile.dump_stats(path + ".pstats")
+
+            report = io.StringIO()
+            pstats.Stats(profile, stream=report).sort_stats("cumulative").print_stats(40)
+            with open(path + ".txt", "w") as f:
+                f.write(report.getvalue())
+
+            counts = self.sampler.counts.get((endpoint, stage), {}) if self.sampler is not None else {}
+            with open(path + ".collapsed", "w") as f:
+                for stack, count in sorted(counts.items()):
+                    f.write("{} {}\n".format(stack, count))
+
+        logger.info("Wrote profiles to %s", self.run_dir, extra={"profile_dir": self.run_dir})
+
+        return self.run_dir
@@ -0,0 +1,158 @@
+"""
+Declarative description of every extraction job, keyed by job name (the name of the old
+per-endpoint script). Jobs with a `parent` are extracted once per parent record, filtered
+by `index`, after the parent job has run.
+
+page_count: "probe" trusts the count from the first page (the page_count attribute, or 1 if
+the page has records), and "sweep", for endpoints that don't report one, skips the count
+altogether and fetches pages until one comes back empty, keeping up to `window` pages in
+flight and running at most `overshoot` pages past the last one with records. Those are the
+pages in flight too, so `window` only binds below `overshoot`
+"""
+
+ENDPOINTS = {
+    "broadcasts": {
+        "endpoint": "broadcasts",
+        "container": "broadcasts",
+        "record": "broadcast",
+        "api_incremental_key": "start_time",
+        "db_incremental_key": "delivery_time",
+        "limit": 1000,
+        "min_pages": 1,
+        "page_count": "probe",
+        "always_full_build": True,
+    },
+    "campaigns": {
+        "endpoint": "campaigns",
+        "container": "campaigns",
+        "record": "campaign",
+        "api_incremental_key": None,
+        "db_incremental_key": None,
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "probe",
+        "always_full_build": True,
+    },
+    "groups": {
+        "endpoint": "groups",
+        "container": "groups",
+        "record": "group",
+        "api_incremental_key": None,
+        "db_incremental_key": None,
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "probe",
+        "always_full_build": True,
+    },
+    "tags": {
+        "endpoint": "tags",
+        "container": "tags",
+        "record": "tag",
+        "api_incremental_key": None,
+        "db_incremental_key": None,
+        "limit": 500,
+        "min_pages": 2,
+        "page_count": "probe",
+        "always_full_build": True,
+    },
+    "tinyurls": {
+        "endpoint": "tinyurls",
+        "container": "tinyurls",
+        "record": "tinyurl",
+        "api_incremental_key": None,
+        "db_incremental_key": None,
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "probe",
+        "always_full_build": True,
+    },
+    "profiles": {
+        "endpoint": "profiles",
+        "container": "profiles",
+        "record": "profile",
+        "api_incremental_key": "from",
+        "db_incremental_key": "updated_at",
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "sweep",
+        "window": 40,
+        "overshoot": 40,
+    },
+    "incoming_messages": {
+        "endpoint": "messages",
+        "container": "messages",
+        "record": "message",
+        "api_incremental_key": "start_time",
+        "db_incremental_key": "received_at",
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "probe",
+        "parent": "campaigns",
+        "index": "campaign_id",
+        "label": "CAMPAIGN",
+        "stream": True,
+        "parse_workers": True,
+    },
+    "outgoing_messages": {
+        "endpoint": "sent_messages",
+        "container": "messages",
+        "record": "message",
+        "api_incremental_key": "start_time",
+        "db_incremental_key": "sent_at",
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "probe",
+        "parent": "campaigns",
+        "index": "campaign_id",
+        "label": "CAMPAIGN",
+        "stream": True,
+        "parse_workers": True,
+        # The master campaign aggregates every other campaign and is far too slow to pull
+        "exclude": ["169115"],
+    },
+    "campaigns_subscribers": {
+        "endpoint": "campaign_subscribers",
+        "container": "subscriptions",
+        "record": "sub",
+        "api_incremental_key": "from",
+        "db_incremental_key": "activated_at",
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "sweep",
+        "window": 8,
+        "overshoot": 4,
+        "parent": "campaigns",
+        "index": "campaign_id",
+        "label": "CAMPAIGN",
+    },
+    "groups_members": {
+        "endpoint": "group_members",
+        "container": "group",
+        "record": "profile",
+        "api_incremental_key": "from",
+        "db_incremental_key": "updated_at",
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "sweep",
+        "window": 8,
+        "overshoot": 4,
+        "parent": "groups",
+        "index": "group_id",
+        "label": "GROUP",
+    },
+    "urls_clicks": {
+        "endpoint": "clicks",
+        "container": "clicks",
+        "record": "click",
+        "api_incremental_key": "from",
+        "db_incremental_key": "created_at",
+        "limit": 500,
+        "min_pages": 1,
+        "page_count": "sweep",
+        "window": 8,
+        "overshoot": 4,
+        "parent": "tinyurls",
+        "index": "url_id",
+        "label": "TINYURL",
+    },
+}
@@ -0,0 +1,486 @@
+"""
+Runs any subset of the extraction jobs in mobile_commons_registry concurrently inside one
+event loop, sharing the HTTP pool, DB engine and rate limiters. E.g.
+
+    python mobile_commons_runner.py profiles incoming_messages
+
+runs those two jobs, and no arguments runs every job.
+
+API documentation can be found at: https://community.uplandsoftware.com/hc/en-us/articles/204494185-REST-API
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import os
+import sys
+import pandas as pd
+import aiohttp
+import mobile_commons_etl as mc
+import mobile_commons_engine as mce
+import mobile_commons_limiter as mcl
+import mobile_commons_loader as mcb
+import mobile_commons_logging as mclg
+import mobile_commons_metrics as mcm
+import mobile_commons_profiling as mcpr
+import mobile_commons_registry as mcr
+import mobile_commons_state as mcst
+
+from concurrent.futures import ProcessPoolExecutor
+
+FULL_REBUILD_FLAG = os.getenv("FULL_REBUILD_FLAG")
+MC_USER = os.getenv("MC_USERNAME")
+MC_PWD = os.getenv("MC_PASSWORD")
+SCHEMA = os.getenv("SCHEMA")
+TABLE_PREFIX = os.getenv("TABLE_PREFIX")
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count()))
+# Campaigns/groups/tinyurls extracted at once across all jobs, requests are still bounded by the limiters
+MAX_CHILDREN = int(os.getenv("MAX_CHILDREN", 16))
+# Where to write a JSON summary of the run (rows, stage times and request stats), e.g. for XCom
+RUN_SUMMARY = os.getenv("RUN_SUMMARY")
+
+# Overridden to point the jobs at a stand-in API such as mobile_commons_mock
+URL = os.getenv("MC_BASE_URL", "https://secure.mcommons.com/api/")
+MAX_PAGES = 20000
+AUTH = aiohttp.BasicAuth(MC_USER or "", password=MC_PWD or "")
+
+# Mobile Commons API allows up to 160 concurrent connections but they asked us to reduce to 80 for now,
+# so the limiter grows towards 80 while responses stay healthy and backs off when we get throttled
+CONCURRENCY = 80
+
+logger = mclg.get_logger("runner")
+
+
+class runner:
+    def __init__(self, jobs, max_children=MAX_CHILDREN, profile_dir=mcpr.PROFILE_DIR):
+
+        self.jobs = jobs
+        self.max_children = max_children
+        self.children = None
+        self.parents = {}
+        self.semaphore = mcl.adaptive_limiter(floor=10, ceiling=CONCURRENCY)
+        # Shared with any other run on this machine so they stay within the same budget together
+        self.host_limiter = mcl.host_limiter(slots=CONCURRENCY)
+        self.watermarks = mcst.watermark_store(schema=SCHEMA, table_prefix=TABLE_PREFIX)
+        self.client_session = None
+        self.executor = None
+        self.rows = {}
+        self.rebuilds = set()
+        self.metrics = mcm.run_metrics()
+        self.profiler = mcpr.profiler(profile_dir)
+
+    async def run(self):
+        """Runs every job concurrently, returning the names of the jobs that failed"""
+
+        self.client_session = mc.create_client_session(CONCURRENCY)
+        self.children = asyncio.Semaphore(self.max_children)
+
+        # Pages parsed in worker processes would be missing from the profiles, so they're parsed inline
+        if any(mcr.ENDPOINTS[job].get("parse_workers") for job in self.jobs) and not self.profiler.enabled:
+            self.executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+
+        try:
+            if self.profiler.enabled:
+                # One job at a time, so each endpoint's profile only holds its own work
+                results = []
+                for job in self.jobs:
+                    results += await asyncio.gather(self.run_job(job), return_exceptions=True)
+            else:
+                results = await asyncio.gather(
+                    *(self.run_job(job) for job in self.jobs), return_exceptions=True
+                )
+
+        finally:
+            await self.client_session.close()
+            self.semaphore.close()
+            self.host_limiter.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+            mce.dispose_engines()
+            self.profiler.close()
+
+        limiter = self.semaphore.stats()
+        self.metrics.gauge("limiter_limit", limiter["limit"], "Concurrency limit at the end of the run")
+        self.metrics.gauge("limiter_backoffs", limiter["backoffs"], "Times the concurrency limit was cut")
+
+        failed = []
+
+        for job, result in zip(self.jobs, results):
+            if isinstance(result, BaseException):
+                logger.error("Job %s failed: %r", job, result, exc_info=result, extra={"job": job})
+                failed.append(job)
+
+        return failed
+
+    async def run_job(self, job):
+
+        spec = mcr.ENDPOINTS[job]
+
+        with self.metrics.timer("total", spec["endpoint"]):
+            if spec.get("parent") is not None:
+                await self.extract_children(job)
+            else:
+                await self.parent(job)
+
+    def summary(self, failed):
+        """Rows loaded and seconds spent per stage for every job, then the metrics of every endpoint"""
+
+        jobs = {}
+
+        for job in self.jobs:
+            stages = self.metrics.stage_totals(mcr.ENDPOINTS[job]["endpoint"])
+            jobs[job] = {
+                "rows": self.rows.get(job, 0),
+                "failed": job in failed,
+                "seconds": {stage: round(values["seconds"], 3) for stage, values in stages.items()},
+            }
+
+        summary = {"jobs": jobs, "failed": failed, "limiter": self.semaphore.stats()}
+        summary.update(self.metrics.summary())
+
+        return summary
+
+    def parent(self, job):
+        """Extracts and loads a top-level job once per run, however many jobs depend on it"""
+
+        if job not in self.parents:
+            self.parents[job] = asyncio.ensure_future(self.extract_endpoint(job))
+
+        return self.parents[job]
+
+    def full_build(self, job):
+
+        if mcr.ENDPOINTS[job].get("always_full_build", False) or (job in self.rebuilds):
+            return True
+
+        return str.lower(FULL_REBUILD_FLAG or "") == "true"
+
+    async def check_column_types(self, job):
+        """
+        Rebuilds a job's table in full when its column types differ from the declared ones, since
+        incremental loads append to the table as it is and would leave the new types unapplied
+        """
+
+        if self.full_build(job):
+            return
+
+        tap = self.connection(job)
+        changed = await self.in_thread(tap.changed_column_types, tap.endpoint)
+
+        if len(changed) > 0:
+            logger.warning(
+                "Column types of job %s changed (%s), running a full build",
+                job,
+                ", ".join("{} {} -> {}".format(c, *types) for c, types in sorted(changed.items())),
+                extra={"job": job, "columns": sorted(changed)},
+            )
+            self.rebuilds.add(job)
+
+    def connection(self, job, **kwargs):
+        """Builds a connection for a job that shares this run's pools and limiters"""
+
+        spec = mcr.ENDPOINTS[job]
+        endpoint = spec["endpoint"]
+
+        keywords = {
+            "user": MC_USER,
+            "pw": MC_PWD,
+            "base": URL,
+            "endpoint_key": {1: {endpoint: spec["container"]}, 0: {endpoint: spec["record"]}},
+            "api_incremental_key": spec["api_incremental_key"],
+            "limit": spec["limit"],
+            "min_pages": spec["min_pages"],
+            "max_pages": MAX_PAGES,
+            "semaphore": self.semaphore,
+            "host_limiter": self.host_limiter,
+            "pool_size": CONCURRENCY,
+            "client_session": self.client_session,
+            "watermarks": self.watermarks,
+            "metrics": self.metrics,
+            "profiler": self.profiler,
+            "stream": spec.get("stream", False),
+            "auth": AUTH,
+            "schema": SCHEMA,
+            "table_prefix": TABLE_PREFIX,
+            "db_incremental_key": spec["db_incremental_key"],
+        }
+
+        if spec.get("parse_workers", False):
+            keywords["executor"] = self.executor
+
+        keywords.update(kwargs)
+
+        return mc.mobile_commons_connection(endpoint, self.full_build(job), **keywords)
+
+    async def in_thread(self, func, *args, **kwargs):
+        """Runs a blocking call (DB queries and loads) off the event loop"""
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def find_page_count(self, job, tap):
+        """Probes the first page for the page count. It's kept, so a single page costs exactly one request"""
+
+        return await tap.page_count_probe(mcr.ENDPOINTS[job]["min_pages"])
+
+    async def fetch(self, job, tap, name):
+        """Fetches every page of a job's result set with the job's pagination mode"""
+
+        spec = mcr.ENDPOINTS[job]
+        # Slices are summarized by extract_children, so only top-level result sets are logged at INFO
+        log = logger.info if tap.index_id is None else logger.debug
+
+        if spec["page_count"] == "sweep":
+            # No page count to find, pages are fetched until one comes back empty
+            data = await tap.sweep_endpoint_async(
+                window=spec.get("window", mc.SWEEP_WINDOW),
+                overshoot=spec.get("overshoot", mc.SWEEP_OVERSHOOT),
+            )
+
+            if data is None:
+                log("No new results to load for endpoint %s", name, extra=tap.log_fields())
+            else:
+                log(
+                    "Fetched %s pages for endpoint %s",
+                    tap.page_count,
+                    name,
+                    extra=tap.log_fields(pages=tap.page_count),
+                )
+
+            return data
+
+        tap.page_count = await self.find_page_count(job, tap)
+
+        if tap.page_count == 0:
+            log("No new results to load for endpoint %s", name, extra=tap.log_fields())
+            return None
+
+        log(
+            "There are %s pages in the result set for endpoint %s",
+            tap.page_count,
+            name,
+            extra=tap.log_fields(pages=tap.page_count),
+        )
+
+        return await tap.ping_endpoint_async()
+
+    async def extract_endpoint(self, job):
+        """Extracts and loads a top-level endpoint, returning the extracted records"""
+
+        spec = mcr.ENDPOINTS[job]
+        endpoint = spec["endpoint"]
+
+        await self.check_column_types(job)
+        tap = self.connection(job)
+
+        await self.in_thread(tap.fetch_latest_timestamp)
+
+        logger.info(
+            "Kicking off extraction for endpoint %s...", str.upper(endpoint), extra=tap.log_fields()
+        )
+
+        with self.metrics.timer("extract", endpoint), self.profiler.region(endpoint, "extract"):
+            data = await self.fetch(job, tap, str.upper(endpoint))
+
+        template = pd.DataFrame(columns=tap.columns)
+
+        if data is not None:
+
+            df = pd.concat([template, data], sort=True, join="inner")
+            logger.info(
+                "Loading data from endpoint %s into database...",
+                str.upper(endpoint),
+                extra=tap.log_fields(rows=df.shape[0]),
+            )
+
+            await self.in_thread(tap.load, df, endpoint)
+            # After the load, so a retried run doesn't land the same batch twice
+            await self.in_thread(tap.write_parquet, df, endpoint)
+
+            self.rows[job] = df.shape[0]
+
+        tap.clear_spool()
+
+        return data
+
+    async def extract_child(self, job, i, watermarks=None):
+        """Extracts one parent record's slice of a child endpoint, returning it with its connection"""
+
+        spec = mcr.ENDPOINTS[job]
+        endpoint = spec["endpoint"]
+        name = "{} {} {}".format(str.upper(endpoint), spec["label"], i)
+
+        subtap = self.connection(job, **{spec["index"]: i})
+        subtap.index = spec["index"]
+
+        await self.in_thread(subtap.fetch_latest_timestamp, watermarks)
+
+        logger.debug("Kicking off extraction for endpoint %s...", name, extra=subtap.log_fields())
+
+        with self.metrics.timer("extract", endpoint, i), self.profiler.region(endpoint, "extract"):
+            data = await self.fetch(job, subtap, name)
+
+        template = pd.DataFrame(columns=subtap.columns)
+
+        if data is None:
+            return subtap, None
+
+        df = pd.concat([template, data], sort=True, join="inner")
+        df[spec["index"]] = str(i)
+        return subtap, df
+
+    async def extract_children(self, job):
+        """Extracts a child endpoint for every record of its parent, loading the slices in batches"""
+
+        spec = mcr.ENDPOINTS[job]
+        endpoint = spec["endpoint"]
+
+        data = await self.parent(spec["parent"])
+
+        if data is None:
+            logger.info(
+                "No %s to extract endpoint %s for",
+                spec["parent"],
+                str.upper(endpoint),
+                extra={"endpoint": endpoint},
+            )
+            return
+
+        exclude = spec.get("exclude", [])
+        indices = [str(ix) for ix in set(data["id"].dropna()) if str(ix) not in exclude]
+
+        await self.check_column_types(job)
+        watermarks = None
+
+        if (not self.full_build(job)) & (spec["db_incremental_key"] is not None):
+            # One lookup for every slice instead of a query per campaign/group/tinyurl
+            lookup = self.connection(job)
+            lookup.index = spec["index"]
+            watermarks = await self.in_thread(lookup.get_latest_records, endpoint, indices)
+
+        tap = self.connection(job)
+        tap.index = spec["index"]
+        loader = mcb.batch_loader(tap, endpoint)
+        empty = []
+
+        logger.info(
+            "Kicking off extraction for endpoint %s across %s %ss...",
+            str.upper(endpoint),
+            len(indices),
+            str.lower(spec["label"]),
+            extra={"endpoint": endpoint, "slices": len(indices)},
+        )
+        progress = mclg.progress(
+            logger,
+            str.upper(endpoint),
+            unit=str.lower(spec["label"]) + "s",
+            total=len(indices),
+            fields={"endpoint": endpoint},
+        )
+
+        async def bounded(i):
+            async with self.children:
+                subtap, df = await self.extract_child(job, i, watermarks)
+
+                progress.update(rows=0 if df is None else df.shape[0])
+
+                if df is None:
+                    empty.append(i)
+                    subtap.clear_spool()
+                else:
+                    # Loaded in batches as slices arrive, so the endpoint never sits in memory whole.
+                    # The slot is held until the loader takes the slice, so fetching waits on loads
+                    await loader.add(df, subtap)
+
+        tasks = [asyncio.ensure_future(bounded(i)) for i in indices]
+
+        try:
+            await asyncio.gather(*tasks)
+            await loader.close()
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.in_thread(loader.abort)
+            raise
+
+        self.rows[job] = loader.rows
+        progress.log()
+
+        if loader.rows == 0:
+            logger.info("No new data from endpoint %s", str.upper(endpoint), extra={"endpoint": endpoint})
+
+        elif tap.full_build & (spec["db_incremental_key"] is not None):
+            # Slices with nothing to load have no rows worth scanning for on the next run either
+            await self.in_thread(self.watermarks.set, endpoint, {i: None for i in empty})
+
+
+def run(jobs, max_children=MAX_CHILDREN, profile_dir=mcpr.PROFILE_DIR):
+    """Runs the given jobs in one event loop, exiting non-zero if any of them failed"""
+
+    mclg.configure()
+
+    job_runner = runner(jobs, max_children=max_children, profile_dir=profile_dir)
+    failed = asyncio.run(job_runner.run())
+
+    if RUN_SUMMARY is not None:
+        # On one line, so a BashOperator that cats it pushes the whole summary to XCom
+        with open(RUN_SUMMARY, "w") as f:
+            json.dump(job_runner.summary(failed), f)
+
+    if mcm.METRICS_TEXTFILE is not None:
+        job_runner.metrics.write_textfile(mcm.METRICS_TEXTFILE)
+
+    if len(failed) > 0:
+        sys.exit("Failed jobs: {}".format(", ".join(failed)))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Extract Mobile Commons endpoints into the warehouse"
+    )
+    parser.add_argument(
+        "jobs",
+        nargs="*",
+        metavar="job",
+        help="jobs to run, any of: {} (default: all)".format(", ".join(mcr.ENDPOINTS)),
+    )
+    parser.add_argument(
+        "--max-children",
+        type=int,
+        default=MAX_CHILDREN,
+        help="campaigns/groups/tinyurls extracted concurrently across all jobs",
+    )
+    parser.add_argument(
+        "--log-level",
+        default=mclg.LOG_LEVEL,
+        help="DEBUG logs every page, INFO (the default) logs progress every so often",
+    )
+    parser.add_argument(
+        "--log-format",
+        choices=["text", "json"],
+        default=mclg.LOG_FORMAT,
+        help="json logs one object per line",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=mcpr.PROFILE_DIR,
+        help="profile each endpoint's extraction and load into a run directory under this one, "
+        "running the jobs one at a time",
+    )
+    args = parser.parse_args()
+
+    mclg.configure(level=args.log_level, fmt=args.log_format)
+
+    unknown = [job for job in args.jobs if job not in mcr.ENDPOINTS]
+    if len(unknown) > 0:
+        parser.error("unknown jobs: {}".format(", ".join(unknown)))
+
+    run(args.jobs or list(mcr.ENDPOINTS), max_children=args.max_children, profile_dir=args.profile_dir)
+
+
+if __name__ == "__main__":
+
+    main()
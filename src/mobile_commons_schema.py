@@ -0,0 +1,102 @@
+"""
+Applies the dtypes declared in mobile_commons_data.columns to extracted frames and maps them
+to warehouse column types. Declared dtypes are
+
+    Int64                nullable integer ids and counts
+    boolean              nullable "true"/"false" flags
+    category             low-cardinality enumerations (status, type, carrier_name, ...)
+    datetime64[ns, UTC]  tz-aware timestamps
+    str                  free text, missing values kept as nulls
+"""
+
+import pandas as pd
+import sqlalchemy
+import mobile_commons_logging as mclg
+import mobile_commons_timestamps as mct
+
+BOOLEANS = {"true": True, "false": False}
+
+logger = mclg.get_logger("schema")
+
+
+def cast(series, dtype, length=None):
+    """Casts a column of raw XML strings (or an already cast column) to a declared dtype"""
+
+    if str(series.dtype) == dtype:
+        return series
+
+    if dtype == "Int64":
+        numbers = pd.to_numeric(series, errors="coerce")
+        # The column stays an integer one, whatever isn't a whole number is nulled and logged
+        dropped = numbers.notna() & (numbers % 1 != 0)
+        numbers = numbers.mask(dropped)
+        dropped |= numbers.isna() & series.notna() & (series.astype(str).str.strip() != "")
+
+        if dropped.any():
+            logger.warning(
+                "Dropped %s values of integer column %s: %s",
+                int(dropped.sum()),
+                series.name,
+                list(series[dropped].unique()[:5]),
+                extra={"column": series.name, "dropped": int(dropped.sum())},
+            )
+
+        return numbers.astype("Int64")
+
+    if dtype == "boolean":
+        return series.astype("string").str.lower().map(BOOLEANS).astype("boolean")
+
+    if dtype.startswith("datetime64"):
+        return mct.parse_timestamps(series)
+
+    if dtype in ("str", "category"):
+        text = series.where(series.isna(), series.astype(str))
+        if length is not None:
+            text = text.str.slice(0, length)
+        return text.astype("category") if dtype == "category" else text
+
+    return series.astype(dtype)
+
+
+def apply_schema(df, dtypes, lengths=None):
+    """Casts every declared column of df, leaving undeclared ones (e.g. the parent index) alone"""
+
+    lengths = lengths or {}
+
+    for c in df.columns:
+        if c in dtypes:
+            df[c] = cast(df[c], dtypes[c], lengths.get(c))
+
+    return df
+
+
+def sql_type(dtype, length=None):
+    """Warehouse column type for a declared dtype"""
+
+    if dtype in ("Int64", "int64"):
+        return sqlalchemy.types.BIGINT()
+    elif dtype in ("boolean", "bool"):
+        return sqlalchemy.types.BOOLEAN()
+    elif dtype.startswith("datetime64"):
+        return sqlalchemy.types.DateTime(timezone=True)
+    elif dtype == "float64":
+        return sqlalchemy.types.Float(asdecimal=True)
+    else:
+        return sqlalchemy.types.VARCHAR(length=length or 65535)
+
+
+def type_family(sqltype):
+    """Coarse kind of a warehouse column type, so a reflected column compares with a declared one"""
+
+    if isinstance(sqltype, sqlalchemy.types.Boolean):
+        return "boolean"
+    elif isinstance(sqltype, sqlalchemy.types.Integer):
+        return "integer"
+    elif isinstance(sqltype, sqlalchemy.types.DateTime):
+        return "timestamptz" if sqltype.timezone else "timestamp"
+    elif isinstance(sqltype, (sqlalchemy.types.Float, sqlalchemy.types.Numeric)):
+        return "float"
+    elif isinstance(sqltype, sqlalchemy.types.String):
+        return "text"
+    else:
+        return str(sqltype).lower()
@@ -0,0 +1,97 @@
+"""
+Parquet landing zone for extracted records, laid out as a hive-partitioned dataset
+
+    {parquet_dir}/endpoint={endpoint}/extracted_on={date}/[{index}={parent id}/]part-....parquet
+
+so batches can be reloaded or queried locally without calling the API again. Batches of a
+full build are written under {parquet_dir}/_staging/ (which readers skip) and published once
+the build has been swapped in
+"""
+
+import contextlib
+import datetime
+import os
+import shutil
+import uuid
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import mobile_commons_data as mcd
+import mobile_commons_schema as mcsc
+import mobile_commons_state as mcst
+
+# The landing zone is off unless a directory is configured
+PARQUET_DIR = os.getenv("PARQUET_DIR")
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+
+COLUMNS = mcd.columns()
+
+
+class parquet_sink:
+    """Writes batches of one endpoint's records with the dtypes declared in mobile_commons_data"""
+
+    def __init__(self, root, compression=PARQUET_COMPRESSION):
+
+        self.root = root
+        self.compression = compression
+
+    def frame(self, df, columns, index=None):
+        """Keeps the declared columns (plus the partition index) cast to their declared dtypes"""
+
+        df = df.loc[:, [c for c in df.columns if (c in columns) or (c == index)]].copy()
+        df = mcsc.apply_schema(df, columns, COLUMNS.lengths)
+
+        if index is not None:
+            df[index] = df[index].map(mcst.parent_key)
+
+        return df
+
+    def write(self, df, endpoint, columns, index=None, extracted_on=None, staging=None):
+        """
+        Appends a batch as new files in the dataset (or in a staging directory from staging_dir),
+        returning the number of rows written
+        """
+
+        df = self.frame(df, columns, index=index)
+        df["endpoint"] = endpoint
+        df["extracted_on"] = str(extracted_on or datetime.date.today())
+
+        partitions = ["endpoint", "extracted_on"]
+        if index is not None:
+            partitions.append(index)
+
+        pq.write_to_dataset(
+            pa.Table.from_pandas(df, preserve_index=False),
+            staging or self.root,
+            partition_cols=partitions,
+            compression=self.compression,
+            # A fresh name per batch, so reruns and concurrent jobs never overwrite each other
+            basename_template="part-" + uuid.uuid4().hex + "-{i}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+        return df.shape[0]
+
+    def staging_dir(self):
+        """A fresh directory to write batches to until they're published"""
+
+        return os.path.join(self.root, "_staging", uuid.uuid4().hex)
+
+    def publish(self, staging):
+        """Moves the files written to a staging directory into the dataset"""
+
+        for path, _, names in os.walk(staging):
+            target = os.path.join(self.root, os.path.relpath(path, staging))
+            os.makedirs(target, exist_ok=True)
+            for name in names:
+                os.replace(os.path.join(path, name), os.path.join(target, name))
+
+        self.discard(staging)
+
+    def discard(self, staging):
+
+        shutil.rmtree(staging, ignore_errors=True)
+
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(staging))
@@ -0,0 +1,148 @@
+"""
+Durable spool of fetched pages, so an extraction that dies midway can resume without
+downloading its pages again. Pages live under
+
+    {spool_dir}/{endpoint}/{parent}/{watermark}/page_{page}.xml.gz
+
+next to a manifest.jsonl listing every page written completely
+"""
+
+import asyncio
+import gzip
+import json
+import os
+import re
+import shutil
+import time
+
+import mobile_commons_logging as mclg
+
+# Spooling is off unless a directory is configured
+SPOOL_DIR = os.getenv("SPOOL_DIR")
+# Spools untouched for longer than this are from an abandoned run rather than one being retried,
+# which matters for full builds whose watermark never changes
+SPOOL_TTL_HOURS = float(os.getenv("SPOOL_TTL_HOURS", 12))
+
+logger = mclg.get_logger("spool")
+
+
+def slug(value):
+    """Filesystem-safe directory name for an endpoint, parent id or watermark"""
+
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", str(value))
+
+
+class page_spool:
+    """Compressed raw pages of one endpoint/parent/watermark result set plus their manifest"""
+
+    def __init__(self, spool_dir, endpoint, parent=None, watermark=None, ttl_hours=SPOOL_TTL_HOURS):
+
+        self.root = os.path.join(spool_dir, slug(endpoint), slug(parent or "all"))
+        self.path = os.path.join(self.root, slug(watermark or "full"))
+        self.manifest = os.path.join(self.path, "manifest.jsonl")
+        self.ttl = ttl_hours * 60 * 60
+        self.pages = None
+
+    def open(self):
+        """Reads the manifest left by an earlier attempt, dropping spools of older watermarks"""
+
+        if self.pages is not None:
+            return
+
+        if os.path.isdir(self.root):
+            for name in os.listdir(self.root):
+                stale = os.path.join(self.root, name)
+                if stale != self.path:
+                    shutil.rmtree(stale, ignore_errors=True)
+
+        if os.path.exists(self.manifest) and (time.time() - os.path.getmtime(self.manifest) > self.ttl):
+            logger.info("Discarding expired spool %s", self.path)
+            shutil.rmtree(self.path, ignore_errors=True)
+
+        os.makedirs(self.path, exist_ok=True)
+        self.pages = {}
+
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by the crash, its page is simply fetched again
+                        continue
+                    if os.path.exists(os.path.join(self.path, entry["file"])):
+                        self.pages[entry["page"]] = entry["file"]
+
+        if len(self.pages) > 0:
+            logger.info(
+                "Resuming from %s spooled pages in %s",
+                len(self.pages),
+                self.path,
+                extra={"pages": len(self.pages)},
+            )
+
+    async def read(self, page):
+        """Raw response of a spooled page, or None if it hasn't been fetched yet"""
+
+        self.open()
+
+        if page not in self.pages:
+            return None
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.read_file, self.pages[page])
+
+    def read_file(self, name):
+
+        with gzip.open(os.path.join(self.path, name), "rb") as f:
+            return f.read()
+
+    async def write(self, page, data):
+        """Spools a raw response, recording it in the manifest only once the file is complete"""
+
+        self.open()
+
+        name = f"page_{page:06d}.xml.gz"
+        loop = asyncio.get_event_loop()
+        size = await loop.run_in_executor(None, self.write_file, name, data)
+
+        with open(self.manifest, "a") as f:
+            f.write(json.dumps({"page": page, "file": name, "bytes": size}) + "\n")
+
+        self.pages[page] = name
+
+    def discard(self, page):
+        """Forgets a spooled page, e.g. one spooled before it was checked, so it's fetched again"""
+
+        self.open()
+
+        name = self.pages.pop(page, None)
+        if name is not None:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def write_file(self, name, data):
+
+        target = os.path.join(self.path, name)
+        partial = target + ".partial"
+
+        with gzip.open(partial, "wb", compresslevel=3) as f:
+            f.write(data)
+
+        os.replace(partial, target)
+        return os.path.getsize(target)
+
+    def clear(self):
+        """Removes the spool once its pages are safely loaded"""
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.pages = None
+
+        for directory in (self.root, os.path.dirname(self.root)):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Still holds other parents' spools
+                break
@@ -0,0 +1,149 @@
+"""
+High-water marks of every (endpoint, parent id) pair, kept in a small table next to the
+loaded ones so incremental runs don't have to scan the target tables for max() timestamps
+"""
+
+import pandas as pd
+import sqlalchemy
+import mobile_commons_engine as mce
+
+# Parent id recorded for endpoints that aren't extracted per campaign/group/tinyurl
+NO_PARENT = ""
+
+
+def parent_key(parent):
+    """Parent id as recorded, so 100, 100.0 and "100.0" (ids cast to float64 on load) all match "100" """
+
+    if parent is None:
+        return NO_PARENT
+
+    try:
+        number = float(parent)
+    except (TypeError, ValueError):
+        return str(parent)
+
+    if number.is_integer():
+        return str(int(number))
+
+    return str(parent)
+
+
+class watermark_store:
+    """Reads and advances the watermarks in {schema}.{table_prefix}_watermarks"""
+
+    def __init__(self, sql_engine=None, schema="public", table_prefix=""):
+
+        self.engine = sql_engine
+        self.schema = schema
+        self.table = f'{schema}."{table_prefix}_watermarks"'
+        self.created = False
+
+    @property
+    def sql_engine(self):
+
+        return self.engine or mce.get_engine()
+
+    def create(self):
+
+        if self.created:
+            return
+
+        with self.sql_engine.begin() as conn:
+            conn.execute(
+                sqlalchemy.text(
+                    f"""create table if not exists {self.table} (
+                        endpoint varchar(256) not null,
+                        parent_id varchar(256) not null,
+                        watermark timestamptz,
+                        updated_at timestamptz not null
+                    )"""
+                )
+            )
+
+        self.created = True
+
+    def get_all(self, endpoint):
+        """Every recorded watermark of an endpoint, keyed by parent id (None if it has no records)"""
+
+        self.create()
+
+        df = pd.read_sql(
+            sqlalchemy.text(
+                f"select parent_id, watermark from {self.table} where endpoint = :endpoint"
+            ),
+            self.sql_engine,
+            params={"endpoint": endpoint},
+        )
+
+        return {
+            row.parent_id: (None if pd.isnull(row.watermark) else str(row.watermark))
+            for row in df.itertuples()
+        }
+
+    def get(self, endpoint, parent=None):
+        """Returns (found, watermark), found being False when the pair has never been recorded"""
+
+        watermarks = self.get_all(endpoint)
+        parent = parent_key(parent)
+
+        return parent in watermarks, watermarks.get(parent)
+
+    def set(self, endpoint, watermarks, replace=False):
+        """
+        Records watermarks keyed by parent id in one transaction. Existing marks only move
+        forward unless replace is set, which also forgets every parent not given (full builds)
+        """
+
+        self.create()
+
+        rows = [
+            {
+                "endpoint": endpoint,
+                "parent_id": parent_key(parent),
+                "watermark": None if pd.isnull(watermark) else pd.Timestamp(watermark),
+                "updated_at": pd.Timestamp.now(tz="UTC"),
+            }
+            for parent, watermark in watermarks.items()
+        ]
+
+        with self.sql_engine.begin() as conn:
+
+            if replace:
+                conn.execute(
+                    sqlalchemy.text(f"delete from {self.table} where endpoint = :endpoint"),
+                    {"endpoint": endpoint},
+                )
+
+            else:
+                current = conn.execute(
+                    sqlalchemy.text(
+                        f"select parent_id, watermark from {self.table} where endpoint = :endpoint"
+                    ),
+                    {"endpoint": endpoint},
+                )
+                latest = {parent: watermark for parent, watermark in current}
+
+                for row in rows:
+                    previous = latest.get(row["parent_id"])
+                    if (previous is not None) and (
+                        (row["watermark"] is None) or (pd.Timestamp(previous) > row["watermark"])
+                    ):
+                        row["watermark"] = pd.Timestamp(previous)
+
+                if len(rows) > 0:
+                    conn.execute(
+                        sqlalchemy.text(
+                            f"delete from {self.table} "
+                            "where endpoint = :endpoint and parent_id = :parent_id"
+                        ),
+                        rows,
+                    )
+
+            if len(rows) > 0:
+                conn.execute(
+                    sqlalchemy.text(
+                        f"insert into {self.table} (endpoint, parent_id, watermark, updated_at) "
+                        "values (:endpoint, :parent_id, :watermark, :updated_at)"
+                    ),
+                    rows,
+                )
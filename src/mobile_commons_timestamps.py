@@ -0,0 +1,59 @@
+"""
+Timestamp normalization for extracted columns. Each distinct value is parsed once (many
+messages of a broadcast share a timestamp), trying the formats Mobile Commons and the
+warehouse actually produce before falling back to pandas' per-value inference
+"""
+
+import pandas as pd
+
+# Explicit formats, most common first. Mobile Commons sends "2020-07-20 15:00:00 UTC", the
+# watermark table and older text columns hold "2020-07-20 15:00:00+00:00"
+FORMATS = [
+    "%Y-%m-%d %H:%M:%S UTC",
+    "%Y-%m-%d %H:%M:%S%z",
+    "%Y-%m-%dT%H:%M:%SZ",
+]
+
+
+def parse_unique(values):
+    """Parses distinct timestamp strings to UTC, format by format, leaving NaT for the unparseable"""
+
+    values = pd.Series(values, dtype=object)
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns, UTC]")
+    remaining = values.index
+
+    for fmt in FORMATS:
+        if len(remaining) == 0:
+            break
+
+        attempt = pd.to_datetime(values[remaining], format=fmt, errors="coerce", utc=True)
+        matched = attempt.notna()
+        parsed[remaining[matched.values]] = attempt[matched]
+        remaining = remaining[~matched.values]
+
+    if len(remaining) > 0:
+        parsed[remaining] = pd.to_datetime(values[remaining], errors="coerce", utc=True)
+
+    return parsed
+
+
+def parse_timestamps(series):
+    """Column of timestamp strings (or datetimes) as datetime64[ns, UTC], parsing each distinct value once"""
+
+    if not isinstance(series, pd.Series):
+        series = pd.Series(series)
+
+    if pd.api.types.is_datetime64tz_dtype(series.dtype):
+        return series.dt.tz_convert("UTC")
+
+    if pd.api.types.is_datetime64_dtype(series.dtype):
+        return series.dt.tz_localize("UTC")
+
+    codes, uniques = pd.factorize(series)
+    parsed = pd.DatetimeIndex(parse_unique(uniques.astype(str)))
+
+    return pd.Series(
+        parsed.take(codes, allow_fill=True, fill_value=pd.NaT),
+        index=series.index,
+        name=series.name,
+    )
@@ -0,0 +1,166 @@
+"""
+Smoke test of the COPY load methods against the postgres and minio services in docker-compose.yml
+
+    docker-compose up -d postgres minio
+    python smoke_load.py
+
+loads a page of mock profiles with LOAD_METHOD=copy, then stages it in minio the way s3_copy does
+and checks that the staged parts load back into Postgres and are cleaned up after. Postgres can't
+COPY from S3 (only Redshift can), so the Redshift COPY statement itself is only printed. The DB_*,
+S3_* and AWS_* variables default to the compose services on localhost
+"""
+
+import argparse
+import gzip
+import io
+import os
+import sys
+
+DEFAULTS = {
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "DB_DATABASE": "mobile_commons",
+    "DB_CREDENTIAL_USERNAME": "mobile_commons",
+    "DB_CREDENTIAL_PASSWORD": "mobile_commons",
+    "S3_ENDPOINT_URL": "http://localhost:9000",
+    "S3_BUCKET": "mobile-commons-smoke",
+    "AWS_ACCESS_KEY_ID": "mobile_commons",
+    "AWS_SECRET_ACCESS_KEY": "mobile_commons",
+}
+
+# Before the modules below read them
+for name, default in DEFAULTS.items():
+    os.environ.setdefault(name, default)
+
+import sqlalchemy
+
+import mobile_commons_engine as mce
+import mobile_commons_etl as mc
+import mobile_commons_mock as mcmk
+import mobile_commons_registry as mcr
+
+JOB = "profiles"
+ROWS = 2500
+
+
+def connection(load_method, schema, table_prefix):
+
+    spec = mcr.ENDPOINTS[JOB]
+    endpoint = spec["endpoint"]
+
+    return mc.mobile_commons_connection(
+        endpoint,
+        True,
+        endpoint_key={1: {endpoint: spec["container"]}, 0: {endpoint: spec["record"]}},
+        db_incremental_key=spec["db_incremental_key"],
+        load_method=load_method,
+        schema=schema,
+        table_prefix=table_prefix,
+    )
+
+
+def sample(tap):
+    """A typed frame of mock records, as the runner would load it"""
+
+    body, rows = mcmk.mock_api().result_set(tap.endpoint, None).page(1, ROWS)
+    df, mapper = tap.prepare(tap.parse_page(body))
+
+    return df, mapper
+
+
+def count(table, schema):
+
+    with mce.get_engine().connect() as conn:
+        return conn.execute(sqlalchemy.text(f'select count(*) from {schema}."{table}"')).scalar()
+
+
+def check(label, expected, actual):
+
+    if expected != actual:
+        sys.exit(f"{label}: expected {expected}, got {actual}")
+
+    print(f"{label}: {actual} ok")
+
+
+def smoke_copy(schema, table_prefix):
+
+    tap = connection("copy", schema, table_prefix)
+    df, mapper = sample(tap)
+    table = tap.table_name(tap.endpoint)
+
+    tap.write_table(df, table, "replace", mapper)
+    check("copy replace", df.shape[0], count(table, schema))
+
+    tap.write_table(df, table, "append", mapper)
+    check("copy append", 2 * df.shape[0], count(table, schema))
+
+
+def smoke_s3(schema, table_prefix):
+
+    import boto3
+
+    s3 = boto3.client("s3", endpoint_url=mc.S3_ENDPOINT_URL)
+    if mc.S3_BUCKET not in [bucket["Name"] for bucket in s3.list_buckets()["Buckets"]]:
+        s3.create_bucket(Bucket=mc.S3_BUCKET)
+
+    tap = connection("s3_copy", schema, table_prefix + "_s3")
+    df, mapper = sample(tap)
+    table = tap.table_name(tap.endpoint)
+
+    df.head(0).to_sql(table, tap.sql_engine, schema=schema, if_exists="replace", index=False, dtype=mapper)
+
+    client, prefix, keys = tap.stage_s3(df, table)
+
+    try:
+        listed = s3.list_objects_v2(Bucket=mc.S3_BUCKET, Prefix=prefix).get("Contents", [])
+        check("s3 staged parts", len(keys), len(listed))
+
+        # What Redshift's COPY would do with the parts, through Postgres' COPY FROM STDIN
+        conn = tap.sql_engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            for key in keys:
+                body = gzip.decompress(s3.get_object(Bucket=mc.S3_BUCKET, Key=key)["Body"].read())
+                cursor.copy_expert(
+                    f"copy {tap.copy_statement(df, table)} from stdin with (format csv)",
+                    io.StringIO(body.decode("utf-8")),
+                )
+            conn.commit()
+        finally:
+            conn.close()
+
+        check("s3 parts loaded", df.shape[0], count(table, schema))
+        print("Redshift would run:", tap.s3_copy_sql(df, table, prefix))
+
+    finally:
+        tap.unstage_s3(client, keys)
+
+    listed = s3.list_objects_v2(Bucket=mc.S3_BUCKET, Prefix=prefix).get("Contents", [])
+    check("s3 parts cleaned up", 0, len(listed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Smoke test the copy and s3_copy load methods")
+    parser.add_argument("--schema", default="public")
+    parser.add_argument("--table-prefix", default="mc_smoke", help="prefix of the tables it creates and drops")
+    parser.add_argument("--skip-s3", action="store_true", help="only test LOAD_METHOD=copy")
+    args = parser.parse_args()
+
+    endpoint = mcr.ENDPOINTS[JOB]["endpoint"]
+    tables = [f"{args.table_prefix}_{endpoint}", f"{args.table_prefix}_s3_{endpoint}"]
+
+    try:
+        smoke_copy(args.schema, args.table_prefix)
+        if not args.skip_s3:
+            smoke_s3(args.schema, args.table_prefix)
+
+    finally:
+        with mce.get_engine().begin() as conn:
+            for table in tables:
+                conn.execute(sqlalchemy.text(f'drop table if exists {args.schema}."{table}"'))
+
+
+if __name__ == "__main__":
+
+    main()